@@ -1,7 +1,10 @@
 import click
 import sys
 
+from . import dependency_graph
+from .observer import TqdmObserver
 from .ticks import Date
+from .row_formula import Ref
 from .sheet import Sheet
 
 IN_NUM = [10, 20, 30, 20, 10]
@@ -14,8 +17,11 @@ ROWS = ["期初在庫", "入荷量", "出荷量", "期末在庫"]
 
 
 @click.group()
-def main():
-    pass
+@click.option("--progress/--no-progress", default=True,
+              help="計算の進み具合を表示する")
+def main(progress):
+    if progress:
+        dependency_graph.get().observer = TqdmObserver()
 
 
 @main.command()
@@ -96,4 +102,43 @@ def rowwise():
     sheet.to_csv(sys.stdout)
 
 
+def build_relative() -> Sheet:
+    sheet = Sheet(START, END, ROWS)
+    sheet["期初在庫", START] = 100
+    sheet.set_row_formula("期初在庫", Ref("期末在庫", -1), start=START + 1)
+    sheet.set_row_formula(
+        "期末在庫",
+        Ref("期初在庫") + Ref("入荷量") - Ref("出荷量")
+    )
+
+    today = START
+    while today <= END:
+        sheet["入荷量", today] = IN_NUM[today - START]
+        sheet["出荷量", today] = OUT_NUM[today - START]
+        today += 1
+
+    sheet.calculate()
+    return sheet
+
+
+@main.command()
+def relative():
+    sheet = build_relative()
+    sheet.to_csv(sys.stdout)
+
+
+@main.command()
+@click.option("--socket", "socket_path", default=None,
+              help="このパスのUnixソケットで待ち受ける。省略するとHTTPで待ち受ける")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8000)
+def serve(socket_path, host, port):
+    from . import server
+
+    sheet_server = server.SheetServer({"relative": build_relative()})
+    where = socket_path if socket_path is not None else f"http://{host}:{port}/"
+    click.echo(f"serving on {where}", err=True)
+    server.serve(sheet_server, socket_path, host, port)
+
+
 main()
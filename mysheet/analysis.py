@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .dependency_graph import DependencyGraph
+from .task import Task
+from . import dependency_graph
+
+if TYPE_CHECKING:
+    from .sheet import Sheet
+
+
+@dataclass
+class CSRGraph:
+    """
+    計算グラフを、位相順に並べたノードの番号と、子の番号の配列で表したもの
+    i番目のノードの子は indices[indptr[i]:indptr[i + 1]]
+    """
+    nodes: List[Task]
+    indptr: np.ndarray
+    indices: np.ndarray
+
+    def children(self, i: int) -> np.ndarray:
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+
+@dataclass
+class GraphReport:
+    num_nodes: int
+    num_edges: int
+    num_cells: int
+    # 位相順の各段にあるノードの数。同じ段のノードは並列に計算できる
+    level_widths: np.ndarray
+    # 最も長い経路に含まれるノードの数
+    depth: int
+    # 所要時間(計測していなければノード数)で重み付けした最長経路
+    critical_path: List[Task]
+    critical_path_time: float
+    total_time: float
+    timed: bool
+
+    @property
+    def nodes_per_cell(self) -> float:
+        return self.num_nodes / self.num_cells if self.num_cells > 0 else 0.0
+
+    @property
+    def max_width(self) -> int:
+        return int(self.level_widths.max()) if len(self.level_widths) > 0 else 0
+
+    @property
+    def max_speedup(self) -> float:
+        """
+        並列に計算したときに見込める速度向上の上限(全体の時間 / 最長経路の時間)
+        """
+        if self.critical_path_time == 0:
+            return 1.0
+        return self.total_time / self.critical_path_time
+
+
+def to_csr(g: Optional[DependencyGraph] = None) -> CSRGraph:
+    if g is None:
+        g = dependency_graph.get()
+    nodes = list(g.get_calculation_tasks())
+    index: Dict[Task, int] = {n: i for i, n in enumerate(nodes)}
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    indices = np.empty(g.graph.number_of_edges(), dtype=np.int64)
+    k = 0
+    for i, n in enumerate(nodes):
+        for c in g.graph.successors(n):
+            indices[k] = index[c]
+            k += 1
+        indptr[i + 1] = k
+    return CSRGraph(nodes, indptr, indices)
+
+
+def node_table(sheet: Sheet, csr: CSRGraph) -> np.ndarray:
+    """
+    シートのセルに対応するノードについて、ノード番号、行番号、列番号の表を返す
+    行と列の名前は、sheet.row_namesとsheet.col_namesで引ける
+    """
+    position: Dict[Task, Tuple[int, int]] = {
+        cell.value: (r, c) for r, c, cell in sheet.iter_cells()}
+    rows = [
+        (i, *position[n])
+        for i, n in enumerate(csr.nodes) if n in position
+    ]
+    return np.array(rows, dtype=[
+        ("node", np.int64), ("row", np.int32), ("col", np.int32)])
+
+
+def levels(csr: CSRGraph) -> np.ndarray:
+    """
+    各ノードの段(根からの最長の辺の数)を返す
+    """
+    level = np.zeros(len(csr.nodes), dtype=np.int64)
+    for i in range(len(csr.nodes)):
+        for c in csr.children(i):
+            if level[c] <= level[i]:
+                level[c] = level[i] + 1
+    return level
+
+
+def analyze(g: Optional[DependencyGraph] = None,
+            sheet: Optional[Sheet] = None) -> GraphReport:
+    """
+    計算グラフの大きさ、段ごとの幅、最長経路を求める
+    DependencyGraph.calculate(profile=True)で所要時間を測っていれば、
+    最長経路は所要時間で重み付けして求める
+    """
+    if g is None:
+        g = dependency_graph.get()
+    csr = to_csr(g)
+    n = len(csr.nodes)
+    timed = len(g.timings) > 0
+    weight = np.array([
+        g.timings.get(t, 0.0) if timed else 1.0 for t in csr.nodes
+    ], dtype=np.float64)
+
+    level = levels(csr)
+    widths = np.bincount(level) if n > 0 else np.zeros(0, dtype=np.int64)
+
+    finish = weight.copy()
+    prev = np.full(n, -1, dtype=np.int64)
+    for i in range(n):
+        for c in csr.children(i):
+            if finish[i] + weight[c] > finish[c]:
+                finish[c] = finish[i] + weight[c]
+                prev[c] = i
+    path: List[Task] = []
+    if n > 0:
+        i = int(np.argmax(finish))
+        while i >= 0:
+            path.append(csr.nodes[i])
+            i = int(prev[i])
+        path.reverse()
+
+    if sheet is not None:
+        num_cells = sum(1 for _, _, c in sheet.iter_cells() if c.value in g.graph)
+    else:
+        num_cells = len(g.lineage.parents.keys() | g.lineage.children.keys())
+    return GraphReport(
+        num_nodes=n,
+        num_edges=len(csr.indices),
+        num_cells=num_cells,
+        level_widths=widths,
+        depth=len(widths),
+        critical_path=path,
+        critical_path_time=float(finish.max()) if n > 0 else 0.0,
+        total_time=float(weight.sum()),
+        timed=timed,
+    )
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Set
+
+import numpy as np
+
+from .exceptions import InvalidData
+from .task import Task
+from .value_task import Cell, Constant
+from . import dependency_graph
+
+if TYPE_CHECKING:
+    from .sheet import Sheet
+
+
+EMPTY = 0
+INPUT = 1
+FORMULA = 2
+
+
+def _kind(cell: Cell) -> int:
+    if cell.empty:
+        return EMPTY
+    if cell.row_formula is None and isinstance(cell.formula, Constant):
+        return INPUT
+    return FORMULA
+
+
+def _input(cell: Cell) -> float:
+    if _kind(cell) != INPUT:
+        return np.nan
+    try:
+        return float(cell.formula.value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def save(sheet: Sheet, path: str) -> None:
+    """
+    セルの種類、入力値、計算結果を1つのファイルに保存する
+    数値でない計算結果は保存せず、復元時には未計算として扱う
+    """
+    shape = (sheet.nrow, sheet.ncol)
+    kinds = np.full(shape, EMPTY, dtype=np.int8)
+    inputs = np.full(shape, np.nan)
+    values = np.full(shape, np.nan)
+    done = np.zeros(shape, dtype=bool)
+    # 整数の計算結果は、復元時に整数に戻す
+    ints = np.zeros(shape, dtype=bool)
+    for r, c, cell in sheet.iter_cells():
+        kinds[r, c] = _kind(cell)
+        inputs[r, c] = _input(cell)
+        if not cell.value.done:
+            continue
+        v = cell.value.value
+        try:
+            values[r, c] = v
+            done[r, c] = True
+        except (TypeError, ValueError):
+            continue
+        ints[r, c] = isinstance(v, (int, np.integer)) and not isinstance(v, bool)
+
+    np.savez_compressed(
+        path,
+        rows=np.array(sheet.row_names, dtype=str),
+        cols=np.array(sheet.col_names, dtype=str),
+        kinds=kinds,
+        inputs=inputs,
+        values=values,
+        done=done,
+        ints=ints,
+    )
+
+
+def restore(sheet: Sheet, path: str) -> List[Cell]:
+    """
+    同じ形で組み立て直したシートに、保存した計算結果を戻す
+
+    入力値や種類が保存時と違うセルと、その子孫だけを未計算のまま残し、
+    必要な部分だけを計算する。未計算のまま残したセルを返す
+    """
+    with np.load(path, allow_pickle=False) as data:
+        if list(data["rows"]) != list(sheet.row_names) or \
+           list(data["cols"]) != list(sheet.col_names):
+            raise InvalidData(f"{path}: shape of the sheet does not match")
+        kinds = data["kinds"]
+        inputs = data["inputs"]
+        values = data["values"]
+        done = data["done"]
+        ints = data["ints"]
+
+    g = dependency_graph.get()
+    cells = sorted(sheet.iter_cells(), key=lambda x: (x[0], x[1]))
+    changed: List[Task] = []
+    for r, c, cell in cells:
+        if _kind(cell) != kinds[r, c]:
+            changed.append(cell.value)
+        elif kinds[r, c] == INPUT and \
+                not np.array_equal(_input(cell), inputs[r, c], equal_nan=True):
+            changed.append(cell.value)
+    dirty: Set[Task] = set(changed)
+    dirty.update(g.get_descendants(changed))
+
+    ret: List[Cell] = []
+    for r, c, cell in cells:
+        if cell.empty:
+            continue
+        if cell.value in dirty or not done[r, c]:
+            ret.append(cell)
+            continue
+        v = values[r, c].item()
+        if ints[r, c]:
+            v = int(v)
+        cell.value.restore(v)
+        if kinds[r, c] == FORMULA and cell.row_formula is None:
+            # 式の根の値はセルの値と同じなので、重い@taskの再実行も避けられる
+            # 根より上の部分式は、calculateが未計算のまま飛ばす
+            cell.formula.restore(v)
+
+    for cell in ret:
+        g.evaluate(cell.value)
+    return ret
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import pickle
+from typing import TYPE_CHECKING, Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from .task import Task
+
+if TYPE_CHECKING:
+    from .dependency_graph import DependencyGraph
+
+
+class UnionFind:
+    """
+    互いにつながったノードの集まり(弱連結成分)を、辺を足しながら求める
+    """
+
+    def __init__(self) -> None:
+        self.parent: Dict[Hashable, Hashable] = {}
+        self.size: Dict[Hashable, int] = {}
+
+    def find(self, n: Hashable) -> Hashable:
+        if n not in self.parent:
+            self.parent[n] = n
+            self.size[n] = 1
+            return n
+        while self.parent[n] != n:
+            # 経路を半分に縮めながら根を探す
+            self.parent[n] = self.parent[self.parent[n]]
+            n = self.parent[n]
+        return n
+
+    def union(self, a: Hashable, b: Hashable) -> None:
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+
+    def clear(self) -> None:
+        self.parent.clear()
+        self.size.clear()
+
+
+# 子プロセスに渡す計算グラフと、各成分の未計算のタスク
+# forkで子プロセスを作るので、タスクを直列化せずにそのまま使える
+_graph: Optional[DependencyGraph] = None
+_jobs: List[List[Task]] = []
+
+Result = Tuple[List[Tuple[int, int, Any]], List[Tuple[int, int, BaseException]], List[Tuple[int, int]]]
+
+
+def _run(indices: Sequence[int]) -> Result:
+    """
+    子プロセスで、indicesの成分を計算し、(成分, 位置)ごとの値、例外、飛ばしたタスクを返す
+    """
+    assert _graph is not None
+    values: List[Tuple[int, int, Any]] = []
+    errors: List[Tuple[int, int, BaseException]] = []
+    poisoned: List[Tuple[int, int]] = []
+    for i in indices:
+        for j, task in enumerate(_jobs[i]):
+            _graph._calculate_task(task, False, None)
+            if task in _graph.errors:
+                errors.append((i, j, _picklable(_graph.errors[task])))
+            elif task in _graph.poisoned:
+                poisoned.append((i, j))
+            else:
+                values.append((i, j, task.peek(None)))  # type: ignore
+    return values, errors, poisoned
+
+
+def _picklable(e: BaseException) -> BaseException:
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError(repr(e))
+
+
+def _chunks(jobs: Sequence[Sequence[Task]], n: int) -> List[List[int]]:
+    """
+    成分を、タスクの数がなるべく揃うようにn個の組に分ける
+    """
+    bins: List[List[int]] = [[] for _ in range(min(n, len(jobs)))]
+    loads = [0] * len(bins)
+    for i in sorted(range(len(jobs)), key=lambda i: -len(jobs[i])):
+        k = loads.index(min(loads))
+        bins[k].append(i)
+        loads[k] += len(jobs[i])
+    return bins
+
+
+def calculate_parallel(g: DependencyGraph, processes: Optional[int] = None) -> None:
+    """
+    計算グラフの弱連結成分ごとに、プロセスプールで並列に計算して、結果をタスクに戻す
+    成分が1つしかない場合や、forkが使えない環境では、そのままcalculateする
+    """
+    global _graph, _jobs
+    import multiprocessing
+    jobs = [
+        [t for t in component if not t.done]
+        for component in g.components()
+    ]
+    jobs = [job for job in jobs if len(job) > 0]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if len(jobs) <= 1 or processes <= 1 or \
+            "fork" not in multiprocessing.get_all_start_methods():
+        g.calculate()
+        return
+
+    from .exceptions import CalculationFailed
+    from .observer import Progress
+
+    g.errors.clear()
+    g.poisoned.clear()
+    progress = Progress(g.observer, sum(len(job) for job in jobs))
+    _graph, _jobs = g, jobs
+    try:
+        context = multiprocessing.get_context("fork")
+        # 小さな成分が多くても偏らないよう、プロセス数より多めの組に分ける
+        chunks = _chunks(jobs, processes * 4)
+        with context.Pool(min(processes, len(chunks))) as pool:
+            for values, errors, poisoned in pool.imap_unordered(_run, chunks):
+                for i, j, v in values:
+                    jobs[i][j].restore(v)  # type: ignore
+                    progress.tick(jobs[i][j])
+                for i, j, e in errors:
+                    g.errors[jobs[i][j]] = e  # type: ignore
+                    progress.tick(jobs[i][j])
+                for i, j in poisoned:
+                    g.poisoned.add(jobs[i][j])
+                    progress.tick(jobs[i][j])
+    finally:
+        _graph, _jobs = None, []
+        progress.finish(len(g.errors))
+    if len(g.errors) > 0:
+        first = next(iter(g.errors.values()))
+        raise CalculationFailed(dict(g.errors), len(g.poisoned)) from first
@@ -1,85 +1,483 @@
-from os import stat
-from typing import Deque, Generator, Iterable, Sequence, Set
-from collections import deque
+from __future__ import annotations
 
-import jinja2
-import networkx as nx
-from networkx.exception import NetworkXError
-from tqdm import tqdm
+import heapq
+import time
+from typing import TYPE_CHECKING, Deque, Dict, Generator, Iterable, List, Optional, Sequence, Set, Tuple
+from collections import deque
 
-from .exceptions import CyclicDependency
+from .components import UnionFind, calculate_parallel
+from .digraph import DiGraph
+from .exceptions import CalculationFailed, CyclicDependency
+from .lineage import LineageIndex
+from .observer import NullObserver, Observer, Progress
 from .task import Task
 
+if TYPE_CHECKING:
+    import asyncio
+    import networkx as nx
+
+    from .memo import DiskCache
+
 
-def num_parents(g: nx.DiGraph, n: Task) -> int:
-    ps = g.predecessors(n)
-    return len(list(ps))
+def num_parents(g: DiGraph[Task], n: Task) -> int:
+    return g.in_degree(n)
 
 
-def num_children(g: nx.DiGraph, n: Task) -> int:
-    cs = g.successors(n)
-    return len(list(cs))
+def num_children(g: DiGraph[Task], n: Task) -> int:
+    return g.out_degree(n)
 
 
 class DependencyGraph:
-    def __init__(self) -> None:
-        self.graph = nx.DiGraph()
+    def __init__(self, lazy: bool = False, auto_collect: bool = False) -> None:
+        # networkxは読み込みに時間がかかるので、必要な操作だけを持つ自前のグラフを使う
+        self.graph: DiGraph[Task] = DiGraph()
+        # Trueのとき、未計算のValueTaskを参照すると必要な部分だけをその場で計算する
+        self.lazy = lazy
+        # 常に位相順序を満たすノードの順位(親 < 子)。辺の追加ごとに差分だけ更新する
+        self._order: Dict[Task, int] = {}
+        self._low = 0
+        self._high = 0
+        # セル間の依存関係。演算ノードを省いた索引をCellが更新する
+        self.lineage = LineageIndex()
+        # 子を失った式のノード。collectで、どこからも使われない部分式ごと回収する
+        # 利用者が持っている部分式も壊すので、auto_collectは既定では使わない
+        self.auto_collect = auto_collect
+        self._garbage: Set[Task] = set()
+        # calculate(profile=True)で測った、タスクごとの所要時間(秒)
+        self.timings: Dict[Task, float] = {}
+        # 直前のcalculateで例外を出したタスクと、その子孫で計算を飛ばしたタスク
+        self.errors: Dict[Task, Exception] = {}
+        self.poisoned: Set[Task] = set()
+        # 指定すると、calculateで指紋が同じセルの結果をディスクから再利用する
+        self.cache: Optional[DiskCache] = None
+        # 弱連結成分。辺を足すときは併合し、取り除いたときは次に使うときに求め直す
+        self._components = UnionFind()
+        self._components_dirty = False
+        # 計算の進み具合を受け取るフック。既定では何もしない
+        self.observer: Observer = NullObserver()
 
     def add_dependency(self, parent: Task, child: Task) -> None:
+        if self.graph.has_edge(parent, child):
+            return
+        if parent is child:
+            raise CyclicDependency(describe_path([parent, parent]))
+
+        # 新しいノードは、親なら最小、子なら最大の順位にすれば順序を崩さない
+        if parent not in self._order:
+            self._low -= 1
+            self._order[parent] = self._low
+        if child not in self._order:
+            self._high += 1
+            self._order[child] = self._high
+
+        if self._order[child] < self._order[parent]:
+            self._reorder(parent, child)
         self.graph.add_edge(parent, child)
+        if not self._components_dirty:
+            self._components.union(parent, child)
+
+    def _reorder(self, parent: Task, child: Task) -> None:
+        """
+        Pearce-Kellyのアルゴリズムで、順位が逆転している範囲だけを並べ替える
+        辺 parent -> child が循環を作る場合はCyclicDependencyを送出する
+        """
+        order = self._order
+        lower, upper = order[child], order[parent]
+
+        # childから辿れて、順位がparent以下のノード
+        forward: List[Task] = []
+        came_from: Dict[Task, Optional[Task]] = {child: None}
+        stack: List[Task] = [child]
+        while len(stack) > 0:
+            current = stack.pop()
+            forward.append(current)
+            for c in self.graph.successors(current):
+                if c is parent:
+                    path: List[Task] = [parent]
+                    node: Optional[Task] = current
+                    while node is not None:
+                        path.append(node)
+                        node = came_from[node]
+                    path.reverse()
+                    raise CyclicDependency(describe_path([parent] + path))
+                if c not in came_from and order[c] < upper:
+                    came_from[c] = current
+                    stack.append(c)
+
+        # parentへ辿りつけて、順位がchild以上のノード
+        backward: List[Task] = []
+        seen: Set[Task] = {parent}
+        stack = [parent]
+        while len(stack) > 0:
+            current = stack.pop()
+            backward.append(current)
+            for p in self.graph.predecessors(current):
+                if p not in seen and order[p] > lower:
+                    seen.add(p)
+                    stack.append(p)
+
+        backward.sort(key=order.__getitem__)
+        forward.sort(key=order.__getitem__)
+        nodes = backward + forward
+        slots = sorted(order[n] for n in nodes)
+        for n, i in zip(nodes, slots):
+            order[n] = i
+
+    def _remove_node(self, node: Task) -> None:
+        self.graph.remove_node(node)
+        self._components_dirty = True
+        del self._order[node]
+        self.timings.pop(node, None)
+        self.errors.pop(node, None)
+        self.poisoned.discard(node)
+
+    def remove_task(self, node: Task) -> None:
+        """
+        nodeを、つながっている辺ごと計算グラフから取り除く
+        """
+        self._remove_node(node)
 
     def remove_dependency(self, parent: Task, child: Task) -> None:
         self.graph.remove_edge(parent, child)
+        self._components_dirty = True
         if num_parents(self.graph, parent) == 0 and \
            num_children(self.graph, parent) == 0:
-            self.graph.remove_node(parent)
+            self._remove_node(parent)
+        elif parent.collectable and num_children(self.graph, parent) == 0:
+            self._garbage.add(parent)
         if num_parents(self.graph, child) == 0 and \
            num_children(self.graph, child) == 0:
-            self.graph.remove_node(child)
+            self._remove_node(child)
+        if self.auto_collect:
+            self.collect()
+
+    def discard(self, node: Task) -> None:
+        """
+        どこからも使われていない式のノードを、collectで回収する対象にする
+        利用者がまだ持っているかもしれないので、ここでは取り除かない
+        """
+        if node in self.graph and node.collectable and \
+           num_children(self.graph, node) == 0:
+            self._garbage.add(node)
+
+    def collect(self) -> int:
+        """
+        どのセルからも使われなくなった部分式を、計算グラフから取り除く
+        取り除いたノードの数を返す
+        回収した部分式を変数に持っていても、もう式には使えない
+        """
+        freed = 0
+        stack = list(self._garbage)
+        self._garbage.clear()
+        while len(stack) > 0:
+            current = stack.pop()
+            if current not in self.graph or \
+               num_children(self.graph, current) > 0:
+                continue
+            parents = list(self.graph.predecessors(current))
+            self._remove_node(current)
+            freed += 1
+            for p in parents:
+                if num_children(self.graph, p) > 0:
+                    continue
+                if p.collectable:
+                    stack.append(p)
+                elif num_parents(self.graph, p) == 0:
+                    self._remove_node(p)
+        return freed
 
     def get_parents(self, node: Task) -> Iterable[Task]:
         try:
             return self.graph.predecessors(node)
-        except NetworkXError:
-            # nodeが、計算グラフに登録されていない場合、NetworkXErrorが起こる
+        except KeyError:
+            # nodeが、計算グラフに登録されていない場合、KeyErrorが起こる
             return []
 
     def get_children(self, node: Task) -> Iterable[Task]:
         try:
             return self.graph.successors(node)
-        except NetworkXError:
-            # nodeが、計算グラフに登録されていない場合、NetworkXErrorが起こる
+        except KeyError:
+            # nodeが、計算グラフに登録されていない場合、KeyErrorが起こる
             return []
 
+    def get_descendants(self, nodes: Iterable[Task]) -> List[Task]:
+        """
+        nodesのいずれかから辿れるタスクを、位相順に返す
+        """
+        seen: Set[Task] = set()
+        stack: List[Task] = list(nodes)
+        while len(stack) > 0:
+            current = stack.pop()
+            for c in self.get_children(current):
+                if c not in seen:
+                    seen.add(c)
+                    stack.append(c)
+        return sorted(seen, key=self._order.__getitem__)
+
+    def components(self) -> List[List[Task]]:
+        """
+        互いに依存関係でつながらないタスクの集まりを、それぞれ位相順にして返す
+        """
+        if self._components_dirty:
+            self._components.clear()
+            for p, c in self.graph.edges:
+                self._components.union(p, c)
+            self._components_dirty = False
+        groups: Dict[Task, List[Task]] = {}
+        for n in self.get_calculation_tasks():
+            groups.setdefault(self._components.find(n), []).append(n)  # type: ignore
+        return list(groups.values())
+
+    def calculate_parallel(self, processes: Optional[int] = None) -> None:
+        """
+        弱連結成分ごとに、プロセスプールで並列に計算する。components.calculate_parallelを参照
+        """
+        calculate_parallel(self, processes)
+
     def get_calculation_tasks(self) -> Generator[Task, None, None]:
-        if not nx.is_directed_acyclic_graph(self.graph):
-            raise CyclicDependency()
-
-        clone = nx.DiGraph(self.graph)
-        roots: Deque[Task] = deque()
-        for node in clone.nodes:
-            if num_parents(clone, node) == 0:
-                roots.append(node)
-
-        while len(roots) > 0:
-            node = roots.popleft()
-            for child in clone.successors(node):
-                if num_parents(clone, child) == 1:
-                    roots.append(child)
-            clone.remove_node(node)
-            yield node
-
-    def calculate(self) -> None:
-        for task in tqdm(self.get_calculation_tasks(), total=len(self.graph)):
+        # 循環は辺の追加時に弾いているので、順位で並べるだけで位相順になる
+        yield from sorted(self.graph.nodes, key=self._order.__getitem__)
+
+    def calculate(self, profile: bool = False) -> None:
+        """
+        未計算のタスクをすべて計算する
+        profile=Trueのときは、実行したタスクごとの所要時間をtimingsに記録する
+
+        例外を出したタスクはerrorsに、その子孫はpoisonedに記録して飛ばし、
+        影響のない部分の計算を続けてから、最後にCalculationFailedを出す
+        失敗したタスクと子孫は未計算のままなので、原因を直して再びcalculateを
+        呼べば、その部分だけを計算し直す
+        """
+        self.errors.clear()
+        self.poisoned.clear()
+        tasks = list(self.get_calculation_tasks())
+        fingerprints: Dict[Task, Optional[str]] = {}
+        if self.cache is not None:
+            fingerprints = self._restore_cached(tasks)
+        tasks = self._needed(tasks)
+        progress = Progress(self.observer, len(tasks))
+        try:
+            for task in tasks:
+                self._calculate_task(task, profile, fingerprints.get(task))
+                progress.tick(task)
+        finally:
+            # 中断されたときも、進捗の表示を閉じる
+            progress.finish(len(self.errors))
+        if len(self.errors) > 0:
+            first = next(iter(self.errors.values()))
+            raise CalculationFailed(dict(self.errors), len(self.poisoned)) from first
+
+    def _calculate_task(self, task: Task, profile: bool, key: Optional[str]) -> None:
+        if task.done:
+            return
+        if any(p in self.errors or p in self.poisoned
+               for p in self.graph.predecessors(task)):
+            self.poisoned.add(task)
+            return
+        begin = time.perf_counter()
+        try:
             task.run()
+        except Exception as e:
+            self.errors[task] = e
+            return
+        if profile:
+            self.timings[task] = time.perf_counter() - begin
+        if key is not None and task.persistent:
+            self.cache.put(key, task.value)  # type: ignore
+
+    def _restore_cached(self, tasks: Sequence[Task]) -> Dict[Task, Optional[str]]:
+        """
+        タスクの指紋を位相順に求め、キャッシュにある結果を計算済みの値として戻す
+        """
+        assert self.cache is not None
+        fingerprints: Dict[Task, Optional[str]] = {}
+        for task in tasks:
+            key = task.fingerprint(fingerprints)
+            fingerprints[task] = key
+            if key is None or task.done or not task.persistent:
+                continue
+            hit, value = self.cache.lookup(key)
+            if hit:
+                task.restore(value)  # type: ignore
+        return fingerprints
+
+    def _needed(self, tasks: Sequence[Task]) -> List[Task]:
+        """
+        未計算のタスクは、保存の対象か、未計算の子の計算に必要なものだけを残す
+        子がすべてキャッシュやチェックポイントから戻った部分式は実行しない
+        """
+        needed: Set[Task] = set()
+        for task in reversed(tasks):
+            if task.done:
+                continue
+            children = list(self.graph.successors(task))
+            if task.persistent or len(children) == 0 \
+                    or any(c in needed for c in children):
+                needed.add(task)
+        return [t for t in tasks if t.done or t in needed]
+
+    def evaluate(self, node: Task) -> None:
+        """
+        nodeの計算に必要な、未計算の祖先タスクだけを実行する
+        """
+        if node.done:
+            return
+        if node not in self.graph:
+            node.run()
+            return
+
+        pending: Set[Task] = set()
+        stack: Deque[Task] = deque()
+        stack.append(node)
+        while len(stack) > 0:
+            current = stack.pop()
+            if current in pending:
+                continue
+            pending.add(current)
+            for p in self.graph.predecessors(current):
+                if not p.done and p not in pending:
+                    stack.append(p)
+
+        for task in sorted(pending, key=self._order.__getitem__):
+            task.run()
+
+    async def calculate_async(self, concurrency: Optional[int] = None) -> None:
+        """
+        計算可能になった非同期タスクを、イベントループ上で並行に実行する
+        concurrencyを指定すると、同時に実行する非同期タスクの数を制限する
+        同期タスクは、計算可能になった時点でその場で実行する
+        """
+        import asyncio
+        remaining = {n: num_parents(self.graph, n) for n in self.graph.nodes}
+        ready: Deque[Task] = deque(n for n, d in remaining.items() if d == 0)
+        semaphore = None if concurrency is None \
+            else asyncio.Semaphore(concurrency)
+
+        async def run(task: Task) -> Task:
+            if semaphore is None:
+                await task.run_async()
+            else:
+                async with semaphore:
+                    await task.run_async()
+            return task
+
+        progress = Progress(self.observer, len(remaining))
+
+        def release(task: Task) -> None:
+            progress.tick(task)
+            for c in self.graph.successors(task):
+                remaining[c] -= 1
+                if remaining[c] == 0:
+                    ready.append(c)
+
+        running: Set[asyncio.Future] = set()
+        try:
+            while len(ready) > 0 or len(running) > 0:
+                while len(ready) > 0:
+                    task = ready.popleft()
+                    if task.is_async and not task.done:
+                        running.add(asyncio.ensure_future(run(task)))
+                    else:
+                        task.run()
+                        release(task)
+                if len(running) > 0:
+                    finished, running = await asyncio.wait(
+                        running, return_when=asyncio.FIRST_COMPLETED)
+                    for f in finished:
+                        release(f.result())
+        finally:
+            for f in running:
+                f.cancel()
+            progress.finish()
 
     def clear(self) -> None:
         self.graph.clear()
+        self._order.clear()
+        self._low = 0
+        self._high = 0
+        self.lineage.clear()
+        self._garbage.clear()
+        self.timings.clear()
+        self.errors.clear()
+        self.poisoned.clear()
+        self._components.clear()
+        self._components_dirty = False
 
     def update(self, node: Task) -> Sequence[Task]:
+        """
+        nodeを再計算し、値が変わったタスクの子だけを位相順に再計算していく
+        再計算したタスクを返す
+        遅延評価のときは、影響を受けるタスクを未計算に戻すだけにする
+        """
+        return self.update_many([node])
+
+    def update_many(self, nodes: Iterable[Task]) -> Sequence[Task]:
+        """
+        updateを、複数のタスクについてまとめて行う
+        共通の子孫は、1回だけ再計算する
+
+        例外を出したタスクはerrorsに、その子孫はpoisonedに記録して未計算に戻し、
+        影響のない部分の再計算を続けてから、最後にCalculationFailedを出す
+        """
+        if self.lazy:
+            return self._invalidate(nodes)
+
+        self.errors.clear()
+        self.poisoned.clear()
+        recomputed: List[Task] = []
+        queued: Set[Task] = set()
+        heap: List[Tuple[int, Task]] = []
+        for node in nodes:
+            if node not in self.graph:
+                try:
+                    node.refresh()
+                except Exception as e:
+                    self._fail(node, e)
+                    continue
+                recomputed.append(node)
+            elif node not in queued:
+                queued.add(node)
+                heapq.heappush(heap, (self._order[node], node))
+        while len(heap) > 0:
+            _, current = heapq.heappop(heap)
+            if current in self.poisoned:
+                continue
+            try:
+                for p in self.graph.predecessors(current):
+                    if not p.done:
+                        self.evaluate(p)
+                changed = current.refresh()
+            except Exception as e:
+                self._fail(current, e)
+                continue
+            recomputed.append(current)
+            if not changed:
+                continue
+            for c in self.graph.successors(current):
+                if c not in queued:
+                    queued.add(c)
+                    heapq.heappush(heap, (self._order[c], c))
+        if len(self.errors) > 0:
+            first = next(iter(self.errors.values()))
+            raise CalculationFailed(dict(self.errors), len(self.poisoned)) from first
+        return recomputed
+
+    def _fail(self, node: Task, e: Exception) -> None:
+        """
+        再計算に失敗したnodeと、その子孫を未計算に戻す
+        古い値のまま計算済みにしておくと、calculateで計算し直されない
+        """
+        node.reset()
+        self.errors[node] = e
+        if node not in self.graph:
+            return
+        for d in self.graph.descendants(node):
+            d.reset()
+            self.poisoned.add(d)
+
+    def _invalidate(self, nodes: Iterable[Task]) -> Sequence[Task]:
         visited: Set[Task] = set()
-        stack: Deque[Task] = deque()
-        stack.append(node)
+        stack: Deque[Task] = deque(nodes)
         while len(stack) > 0:
             current = stack.pop()
             visited.add(current)
@@ -89,11 +487,43 @@ class DependencyGraph:
                 if c in visited:
                     continue
                 stack.append(c)
-        self.calculate()
         return list(visited)
 
-    def to_dot(self, path: str) -> None:
-        template = jinja2.Template("""
+    def to_networkx(self) -> nx.DiGraph:
+        """
+        networkxのアルゴリズムを使うために、計算グラフをnetworkx.DiGraphに写す
+        """
+        import networkx as nx
+        ret = nx.DiGraph()
+        ret.add_nodes_from(self.graph.nodes)
+        ret.add_edges_from(self.graph.edges)
+        return ret
+
+    def to_dot(self, path: str,
+               around: Optional[Task] = None) -> None:
+        """
+        計算グラフをDOT形式で書き出す
+        aroundを指定すると、そのタスクの祖先と子孫だけを書き出す
+        """
+        if around is None:
+            nodes: Iterable[Task] = self.graph.nodes
+            edges: Iterable[Tuple[Task, Task]] = self.graph.edges
+        else:
+            cone = self.graph.ancestors(around) | \
+                self.graph.descendants(around) | {around}
+            nodes = [n for n in self.graph.nodes if n in cone]
+            edges = [
+                (p, c) for p in nodes for c in self.graph.successors(p) if c in cone
+            ]
+
+        write_dot(
+            path,
+            ((p.name, c.name, None) for p, c in edges),
+            (n.name for n in nodes)
+        )
+
+
+DOT_TEMPLATE = """
 digraph {
   graph [
          charset = "UTF-8",
@@ -132,26 +562,42 @@ digraph {
         labelangle = 70
         ];
 
-{% for e in edges %}
-"{{e[0].name}}" -> "{{e[1].name}}";
+{% for src, dst, label in edges %}
+"{{src}}" -> "{{dst}}"{% if label %} [ label = "{{label}}" ]{% endif %};
 {% endfor %}
 
 {% for n in nodes %}
-"{{n.name}}" [ shape = ellipse ];
+"{{n}}" [ shape = ellipse ];
 {% endfor %}
 }
-""")
+"""
+
 
-        edges = self.graph.edges
-        nodes = self.graph.nodes
+def write_dot(path: str,
+              edges: Iterable[Tuple[str, str, Optional[str]]],
+              nodes: Iterable[str]) -> None:
+    """
+    辺と節点を、メモリ上に文字列を組み立てずに少しずつファイルへ書き出す
+    """
+    import jinja2
+    template = jinja2.Template(DOT_TEMPLATE)
+    template.stream(edges=edges, nodes=nodes).dump(path, encoding="utf-8")
 
-        lines = template.render(dict(
-            edges=edges,
-            nodes=nodes
-        ))
 
-        with open(path, "w") as f:
-            f.write(lines)
+def describe_path(path: Sequence[Task]) -> Sequence[str]:
+    """
+    循環の経路を表示用の名前にする。セルが含まれていればセルだけを並べる
+    セルで始まりセルで終わるよう、最初のセルから一周する順に並べ直す
+    """
+    if len(path) > 1 and path[0] is path[-1]:
+        starts = [i for i, t in enumerate(path[:-1]) if t.label is not None]
+        if len(starts) > 0:
+            i = starts[0]
+            path = list(path[i:-1]) + list(path[:i]) + [path[i]]
+    labels = [t.label for t in path if t.label is not None]
+    if len(labels) > 0:
+        return labels
+    return [t.name for t in path]
 
 
 _SINGLETON = DependencyGraph()
@@ -0,0 +1,92 @@
+from typing import Dict, Generic, Hashable, Iterator, KeysView, List, Set, Tuple, TypeVar
+
+N = TypeVar("N", bound=Hashable)
+
+
+class DiGraph(Generic[N]):
+    """
+    計算グラフに必要な操作だけを持つ有向グラフ
+    networkx.DiGraphと同じ名前のメソッドを持ち、ノードと辺は追加した順に並ぶ
+    存在しないノードを指定すると、KeyErrorが起こる
+    """
+
+    def __init__(self) -> None:
+        self._succ: Dict[N, Dict[N, None]] = {}
+        self._pred: Dict[N, Dict[N, None]] = {}
+
+    def __contains__(self, n: object) -> bool:
+        return n in self._succ
+
+    def __len__(self) -> int:
+        return len(self._succ)
+
+    def __iter__(self) -> Iterator[N]:
+        return iter(self._succ)
+
+    @property
+    def nodes(self) -> KeysView[N]:
+        return self._succ.keys()
+
+    @property
+    def edges(self) -> Iterator[Tuple[N, N]]:
+        return ((u, v) for u, vs in self._succ.items() for v in vs)
+
+    def number_of_edges(self) -> int:
+        return sum(len(vs) for vs in self._succ.values())
+
+    def add_node(self, n: N) -> None:
+        if n not in self._succ:
+            self._succ[n] = {}
+            self._pred[n] = {}
+
+    def add_edge(self, u: N, v: N) -> None:
+        self.add_node(u)
+        self.add_node(v)
+        self._succ[u][v] = None
+        self._pred[v][u] = None
+
+    def has_edge(self, u: N, v: N) -> bool:
+        return u in self._succ and v in self._succ[u]
+
+    def remove_edge(self, u: N, v: N) -> None:
+        del self._succ[u][v]
+        del self._pred[v][u]
+
+    def remove_node(self, n: N) -> None:
+        for v in self._succ.pop(n):
+            del self._pred[v][n]
+        for u in self._pred.pop(n):
+            del self._succ[u][n]
+
+    def predecessors(self, n: N) -> Iterator[N]:
+        return iter(self._pred[n])
+
+    def successors(self, n: N) -> Iterator[N]:
+        return iter(self._succ[n])
+
+    def in_degree(self, n: N) -> int:
+        return len(self._pred[n])
+
+    def out_degree(self, n: N) -> int:
+        return len(self._succ[n])
+
+    def ancestors(self, n: N) -> Set[N]:
+        return self._walk(n, self._pred)
+
+    def descendants(self, n: N) -> Set[N]:
+        return self._walk(n, self._succ)
+
+    def _walk(self, n: N, adj: Dict[N, Dict[N, None]]) -> Set[N]:
+        seen: Set[N] = set()
+        stack: List[N] = list(adj[n])
+        while len(stack) > 0:
+            current = stack.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            stack.extend(adj[current])
+        return seen
+
+    def clear(self) -> None:
+        self._succ.clear()
+        self._pred.clear()
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import math
+from typing import TYPE_CHECKING, Any, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+class Dual:
+    """
+    値と、入力についての微分(grad)の組。前進モードの自動微分に使う
+    四則演算とべき乗、比較ができるので、@task(differentiable=True)の関数にもそのまま渡せる
+    """
+    # NumPyのスカラーとの演算でも、こちらの演算子を使わせる
+    __array_ufunc__ = None
+    # 同じ値でも微分が違えば別物なので、キャッシュのキーにはしない
+    __hash__ = None  # type: ignore
+
+    def __init__(self, value: float, grad: np.ndarray) -> None:
+        self.value = value
+        self.grad = grad
+
+    def __repr__(self) -> str:
+        return f"Dual({self.value!r}, {self.grad!r})"
+
+    def __add__(self, other: Any) -> Dual:
+        if isinstance(other, Dual):
+            return Dual(self.value + other.value, self.grad + other.grad)
+        return Dual(self.value + other, self.grad)
+
+    __radd__ = __add__
+
+    def __sub__(self, other: Any) -> Dual:
+        if isinstance(other, Dual):
+            return Dual(self.value - other.value, self.grad - other.grad)
+        return Dual(self.value - other, self.grad)
+
+    def __rsub__(self, other: Any) -> Dual:
+        return Dual(other - self.value, -self.grad)
+
+    def __mul__(self, other: Any) -> Dual:
+        if isinstance(other, Dual):
+            return Dual(self.value * other.value,
+                        self.grad * other.value + other.grad * self.value)
+        return Dual(self.value * other, self.grad * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other: Any) -> Dual:
+        if isinstance(other, Dual):
+            return Dual(self.value / other.value,
+                        (self.grad * other.value - other.grad * self.value) / other.value ** 2)
+        return Dual(self.value / other, self.grad / other)
+
+    def __rtruediv__(self, other: Any) -> Dual:
+        return Dual(other / self.value, -other * self.grad / self.value ** 2)
+
+    def __pow__(self, other: Union[int, float]) -> Dual:
+        if isinstance(other, Dual):
+            return NotImplemented
+        return Dual(self.value ** other, other * self.value ** (other - 1) * self.grad)
+
+    def __neg__(self) -> Dual:
+        return Dual(-self.value, -self.grad)
+
+    def __pos__(self) -> Dual:
+        return self
+
+    def __abs__(self) -> Dual:
+        return -self if self.value < 0 else self
+
+    # 比較は値だけで行う。maxやminは選んだ側の微分になる
+    def __eq__(self, other: Any) -> bool:  # type: ignore
+        return self.value == primal(other)
+
+    def __ne__(self, other: Any) -> bool:  # type: ignore
+        return self.value != primal(other)
+
+    def __lt__(self, other: Any) -> bool:
+        return self.value < primal(other)
+
+    def __le__(self, other: Any) -> bool:
+        return self.value <= primal(other)
+
+    def __gt__(self, other: Any) -> bool:
+        return self.value > primal(other)
+
+    def __ge__(self, other: Any) -> bool:
+        return self.value >= primal(other)
+
+    def __float__(self) -> float:
+        return float(self.value)
+
+
+def primal(v: Any) -> Any:
+    """
+    Dualなら値を、そうでなければそのまま返す
+    """
+    return v.value if isinstance(v, Dual) else v
+
+
+def exp(v: Any) -> Any:
+    if isinstance(v, Dual):
+        e = math.exp(v.value)
+        return Dual(e, e * v.grad)
+    return math.exp(v)
+
+
+def log(v: Any) -> Any:
+    if isinstance(v, Dual):
+        return Dual(math.log(v.value), v.grad / v.value)
+    return math.log(v)
@@ -1,8 +1,10 @@
-from typing import Any, TypeVar
+from typing import Any, Mapping, Sequence, TypeVar
 
 
 class CyclicDependency(Exception):
-    pass
+    def __init__(self, path: Sequence[str] = ()) -> None:
+        super().__init__(" -> ".join(path))
+        self.path = list(path)
 
 
 class NotEvaluated(Exception):
@@ -26,3 +28,24 @@ class InvalidData(Exception):
 class AccessEmptyCell(Exception):
     def __init__(self, row: str, col: Any) -> None:
         super().__init__(f"row: {row}, col: {col}")
+
+
+class CalculationFailed(Exception):
+    """
+    calculateの途中で例外を出したタスクがあった。errorsはタスクと、その例外
+    poisonedは、失敗したタスクに依存していたため計算しなかったタスクの数
+    """
+
+    def __init__(self, errors: Mapping[Any, Exception], poisoned: int = 0) -> None:
+        names = [
+            f"{t.label or t.name}: {e!r}"
+            for t, e in errors.items()
+        ]
+        super().__init__(
+            f"{len(errors)} failed, {poisoned} skipped: " + ", ".join(names))
+        self.errors = dict(errors)
+        self.poisoned = poisoned
+
+
+class NoSolution(Exception):
+    pass
@@ -0,0 +1,101 @@
+import math
+import operator
+from typing import Callable, Dict, List, Optional
+
+from .dependency_graph import DependencyGraph, num_children
+from .task import Task
+from .value_task import Constant, FunctionTask, ValueTask
+from . import dependency_graph
+
+
+OPERATORS: Dict[Callable, str] = {
+    operator.add: "+",
+    operator.sub: "-",
+    operator.mul: "*",
+    operator.truediv: "/",
+}
+
+
+def _is_operator(t: Task) -> bool:
+    return isinstance(t, FunctionTask) and \
+        t.func in OPERATORS and len(t.kwargs) == 0
+
+
+class _Group:
+    """
+    1つの関数にまとめる演算ノードの集まり
+    """
+
+    def __init__(self, g: DependencyGraph, root: FunctionTask) -> None:
+        self.g = g
+        self.root = root
+        self.leaves: List[ValueTask] = []
+        self.leaf_index: Dict[ValueTask, int] = {}
+        self.removed: List[Task] = []
+        self.source = self._emit_op(root)
+
+    def _is_inner(self, t: Task) -> bool:
+        # 子がこのグループの演算ノードだけなら、まとめて消せる
+        return _is_operator(t) and num_children(self.g.graph, t) == 1
+
+    def _emit_op(self, t: FunctionTask) -> str:
+        left, right = (self._emit(a) for a in t.args)
+        return f"({left} {OPERATORS[t.func]} {right})"
+
+    def _emit(self, t: ValueTask) -> str:
+        # 同じノードの引数に2回現れた演算ノードは、1回目で取り除く側に入っている
+        # 定数も取り除く側に入るが、そちらは下で値を埋め込む
+        if t in self.removed and _is_operator(t):
+            return self._emit_op(t)  # type: ignore
+        if self._is_inner(t):
+            self.removed.append(t)
+            return self._emit_op(t)  # type: ignore
+        if isinstance(t, Constant) and \
+           num_children(self.g.graph, t) == 1 and \
+           type(t.value) in (int, float) and math.isfinite(t.value):
+            if t not in self.removed:
+                self.removed.append(t)
+            return repr(t.value)
+        if t not in self.leaf_index:
+            self.leaf_index[t] = len(self.leaves)
+            self.leaves.append(t)
+        return f"x{self.leaf_index[t]}"
+
+    def compile(self) -> Callable:
+        params = ", ".join(f"x{i}" for i in range(len(self.leaves)))
+        code = compile(f"lambda {params}: {self.source}", "<fused>", "eval")
+        return eval(code)
+
+
+def fuse(g: Optional[DependencyGraph] = None) -> int:
+    """
+    演算子(+, -, *, /)のノードが一本道でつながっている部分を、
+    1つの関数を実行する1つのノードにまとめる
+    まとめた先のノードは元の根のノードなので、セルの式はそのまま使える
+    途中のノードは計算グラフから取り除かれ、値を参照できなくなる
+    取り除いたノードの数を返す
+    """
+    if g is None:
+        g = dependency_graph.get()
+
+    roots: List[FunctionTask] = [
+        t for t in g.graph.nodes
+        if isinstance(t, FunctionTask) and _is_operator(t) and not (
+            num_children(g.graph, t) == 1 and
+            _is_operator(next(iter(g.graph.successors(t)))))
+    ]
+
+    freed = 0
+    for root in roots:
+        group = _Group(g, root)
+        if len(group.removed) == 0:
+            continue
+        for t in group.removed:
+            g.remove_task(t)
+        for leaf in group.leaves:
+            g.add_dependency(leaf, root)
+        root.func = group.compile()
+        root.args = group.leaves
+        root.name += "\n(fused)"
+        freed += len(group.removed)
+    return freed
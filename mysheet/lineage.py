@@ -0,0 +1,68 @@
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from .task import Task
+
+
+class LineageIndex:
+    """
+    セル同士の直接の依存関係を、間の演算ノードを省いて保持する索引
+    """
+
+    def __init__(self) -> None:
+        self.parents: Dict[Task, Dict[Task, None]] = {}
+        self.children: Dict[Task, Dict[Task, None]] = {}
+
+    def set_parents(self, node: Task, parents: Iterable[Task]) -> None:
+        for p in self.parents.pop(node, {}):
+            cs = self.children[p]
+            del cs[node]
+            if len(cs) == 0:
+                del self.children[p]
+
+        new_parents = dict.fromkeys(parents)
+        if len(new_parents) == 0:
+            return
+        self.parents[node] = new_parents
+        for p in new_parents:
+            self.children.setdefault(p, {})[node] = None
+
+    def get_parents(self, node: Task) -> Iterable[Task]:
+        return self.parents.get(node, {}).keys()
+
+    def get_children(self, node: Task) -> Iterable[Task]:
+        return self.children.get(node, {}).keys()
+
+    def ancestors(self, nodes: Iterable[Task],
+                  depth: Optional[int] = None) -> List[Task]:
+        return self._walk(self.parents, nodes, depth)
+
+    def descendants(self, nodes: Iterable[Task],
+                    depth: Optional[int] = None) -> List[Task]:
+        return self._walk(self.children, nodes, depth)
+
+    def clear(self) -> None:
+        self.parents.clear()
+        self.children.clear()
+
+    @staticmethod
+    def _walk(edges: Dict[Task, Dict[Task, None]],
+              nodes: Iterable[Task], depth: Optional[int]) -> List[Task]:
+        """
+        幅優先でたどり、depth段以内のノードを近い順に返す
+        起点は、他の起点からたどり着いた場合だけ含まれる
+        """
+        seen: Set[Task] = set()
+        ret: List[Task] = []
+        queue: Deque[Tuple[Task, int]] = deque((n, 0) for n in nodes)
+        while len(queue) > 0:
+            current, d = queue.popleft()
+            if depth is not None and d >= depth:
+                continue
+            for n in edges.get(current, {}):
+                if n in seen:
+                    continue
+                seen.add(n)
+                ret.append(n)
+                queue.append((n, d + 1))
+        return ret
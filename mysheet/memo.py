@@ -0,0 +1,242 @@
+from collections import OrderedDict
+import functools
+import hashlib
+import inspect
+import pickle
+import time
+import types
+from typing import Any, Callable, Dict, Hashable, Iterable, NamedTuple, Optional, Sequence, Tuple
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class LRUCache:
+    """
+    引数の値をキーに、純粋なタスクの結果を保持するキャッシュ
+    maxsize件を超えると、最も長く使われていない結果から捨てる
+    """
+
+    def __init__(self, maxsize: int = 128) -> None:
+        if maxsize <= 0:
+            raise ValueError(f"maxsize must be positive: {maxsize}")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def _freeze(v: Any) -> Hashable:
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    if isinstance(v, dict):
+        return tuple(sorted((k, _freeze(x)) for k, x in v.items()))
+    hash(v)
+    return v
+
+
+def make_key(args: Sequence[Any], kwargs: Dict[str, Any]) -> Optional[Hashable]:
+    """
+    引数の値からキャッシュのキーを作る。ハッシュできない値があればNone
+    """
+    try:
+        return (_freeze(args), _freeze(kwargs))
+    except TypeError:
+        return None
+
+
+def memoize(f: Callable[..., Any], cache: LRUCache) -> Callable[..., Any]:
+    if inspect.iscoroutinefunction(f):
+        @functools.wraps(f)
+        async def async_wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            if key is not None:
+                hit, value = cache.lookup(key)
+                if hit:
+                    return value
+            value = await f(*args, **kwargs)
+            if key is not None:
+                cache.put(key, value)
+            return value
+        return async_wrapper
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        key = make_key(args, kwargs)
+        if key is not None:
+            hit, value = cache.lookup(key)
+            if hit:
+                return value
+        value = f(*args, **kwargs)
+        if key is not None:
+            cache.put(key, value)
+        return value
+    return wrapper
+
+
+class DiskCache:
+    """
+    タスクの指紋(fingerprint)をキーに、計算結果をSQLiteのファイルに保存するキャッシュ
+    別のプロセスや、次回の実行からも使える
+    保存した結果の合計がmax_bytesを超えると、最も長く使われていない結果から捨てる
+
+    指紋には、関数が参照するグローバル変数の値や、中から呼ぶ別の関数の中身は含まない
+    それらを書き換えても同じ指紋になり、古い結果が返るので、
+    その場合はclearするか、キャッシュのファイルを分けること
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024) -> None:
+        if max_bytes <= 0:
+            raise ValueError(f"max_bytes must be positive: {max_bytes}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        import sqlite3
+        self._conn = sqlite3.connect(path, timeout=30)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+    def lookup(self, key: str) -> Tuple[bool, Any]:
+        row = self._conn.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        with self._conn:
+            self._conn.execute(
+                "UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return True, pickle.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        if len(data) > self.max_bytes:
+            return
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()))
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM results ORDER BY used").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+
+    def size(self) -> int:
+        """
+        保存している結果の合計のバイト数
+        """
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        return int(row[0])
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.max_bytes, self.size())
+
+    def clear(self) -> None:
+        with self._conn:
+            self._conn.execute("DELETE FROM results")
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def digest(*parts: Any) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else str(p).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def digest_value(v: Any) -> Optional[str]:
+    """
+    値の指紋。pickleできない値はNone
+    """
+    try:
+        return digest(b"value", pickle.dumps(v, protocol=4))
+    except Exception:
+        return None
+
+
+def _code_parts(code: types.CodeType) -> Iterable[Any]:
+    yield code.co_code
+    yield code.co_names
+    for c in code.co_consts:
+        # 入れ子の関数のコードは、アドレスを含むreprではなく中身で比べる
+        if isinstance(c, types.CodeType):
+            yield from _code_parts(c)
+        else:
+            yield repr(c)
+
+
+def digest_function(f: Callable[..., Any]) -> Optional[str]:
+    """
+    関数の指紋。名前とバイトコード、クロージャと引数の既定値から作る
+    グローバル変数の値は含まないので、それに依存する関数はpure=Trueにしないこと
+    """
+    f = inspect.unwrap(f)
+    name = f"{getattr(f, '__module__', None)}.{getattr(f, '__qualname__', repr(f))}"
+    code = getattr(f, "__code__", None)
+    if code is None:
+        # 組み込み関数は名前だけで区別する
+        return digest(b"builtin", name)
+    closure = []
+    for c in getattr(f, "__closure__", None) or ():
+        try:
+            closure.append(digest_value(c.cell_contents))
+        except ValueError:
+            # まだ値が入っていないセル
+            closure.append(None)
+    defaults = [
+        digest_value(getattr(f, "__defaults__", None)),
+        digest_value(getattr(f, "__kwdefaults__", None)),
+    ]
+    if None in closure or None in defaults:
+        return None
+    return digest(b"function", name, *_code_parts(code), *closure, *defaults)
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import logging
+import sys
+import time
+from typing import Any, Optional, TextIO
+
+from .task import Task
+
+
+class Observer:
+    """
+    計算の進み具合を受け取るフック。何もしない
+
+    on_task_doneは、タスクがevery個終わるごとに、前回からinterval秒以上経っていれば呼ばれる
+    everyが0なら呼ばれないので、進み具合を見ないときの手間はかからない
+    """
+    every = 0
+    interval = 0.0
+
+    def on_start(self, total: int) -> None:
+        pass
+
+    def on_task_done(self, task: Task, count: int) -> None:
+        pass
+
+    def on_finish(self, count: int, failed: int) -> None:
+        pass
+
+
+class NullObserver(Observer):
+    pass
+
+
+class TqdmObserver(Observer):
+    """
+    進み具合をtqdmのバーで表示する
+    """
+
+    def __init__(self, every: int = 1, interval: float = 0.1,
+                 file: Optional[TextIO] = None) -> None:
+        self.every = every
+        self.interval = interval
+        self.file = file
+        self._bar: Any = None
+
+    def on_start(self, total: int) -> None:
+        from tqdm import tqdm
+        self._bar = tqdm(total=total, file=self.file or sys.stderr)
+
+    def on_task_done(self, task: Task, count: int) -> None:
+        self._bar.update(count - self._bar.n)
+
+    def on_finish(self, count: int, failed: int) -> None:
+        self._bar.update(count - self._bar.n)
+        self._bar.close()
+        self._bar = None
+
+
+class LoggingObserver(Observer):
+    """
+    進み具合をloggingで書き出す。メトリクスの収集などに使う
+    """
+
+    def __init__(self, logger: Optional[logging.Logger] = None,
+                 level: int = logging.INFO,
+                 every: int = 1000, interval: float = 1.0) -> None:
+        self.logger = logger or logging.getLogger("mysheet")
+        self.level = level
+        self.every = every
+        self.interval = interval
+        self._total = 0
+        self._begin = 0.0
+
+    def on_start(self, total: int) -> None:
+        self._total = total
+        self._begin = time.perf_counter()
+        self.logger.log(self.level, "calculation started: %d tasks", total)
+
+    def on_task_done(self, task: Task, count: int) -> None:
+        self.logger.log(self.level, "calculated %d/%d tasks", count, self._total)
+
+    def on_finish(self, count: int, failed: int) -> None:
+        self.logger.log(
+            self.level, "calculation finished: %d tasks, %d failed, %.3fs",
+            count, failed, time.perf_counter() - self._begin)
+
+
+class Progress:
+    """
+    Observerのeveryとintervalに従って、on_task_doneを呼ぶ回数を間引く
+    """
+
+    def __init__(self, observer: Observer, total: int) -> None:
+        self.observer = observer
+        self.count = 0
+        self._next = observer.every
+        self._last = time.perf_counter()
+        observer.on_start(total)
+
+    def tick(self, task: Task) -> None:
+        self.count += 1
+        if self._next <= 0 or self.count < self._next:
+            return
+        self._next = self.count + self.observer.every
+        now = time.perf_counter()
+        if now - self._last >= self.observer.interval:
+            self._last = now
+            self.observer.on_task_done(task, self.count)
+
+    def finish(self, failed: int = 0) -> None:
+        self.observer.on_finish(self.count, failed)
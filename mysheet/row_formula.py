@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+import math
+from typing import Any, Callable, Dict, List, Union
+
+
+class Expr(ABC):
+    """
+    行の式。列の位置からの相対参照(Ref)と、四則演算で組み立てる
+    """
+
+    def __add__(self, other: Operand) -> Expr:
+        return BinOp("+", self, _wrap(other))
+
+    def __radd__(self, other: Operand) -> Expr:
+        return BinOp("+", _wrap(other), self)
+
+    def __sub__(self, other: Operand) -> Expr:
+        return BinOp("-", self, _wrap(other))
+
+    def __rsub__(self, other: Operand) -> Expr:
+        return BinOp("-", _wrap(other), self)
+
+    def __mul__(self, other: Operand) -> Expr:
+        return BinOp("*", self, _wrap(other))
+
+    def __rmul__(self, other: Operand) -> Expr:
+        return BinOp("*", _wrap(other), self)
+
+    def __truediv__(self, other: Operand) -> Expr:
+        return BinOp("/", self, _wrap(other))
+
+    def __rtruediv__(self, other: Operand) -> Expr:
+        return BinOp("/", _wrap(other), self)
+
+    def collect_refs(self, refs: Dict[Ref, None]) -> None:
+        pass
+
+    @abstractmethod
+    def source(self, names: Dict[Ref, str]) -> str:
+        """
+        式を、参照をnamesの変数名に置き換えたPythonの式の文字列にする
+        """
+        pass
+
+
+Operand = Union[Expr, float, int]
+
+
+@dataclass(frozen=True, eq=True)
+class Ref(Expr):
+    """
+    同じ列からoffsetだけずれた列の、row行のセル。Ref("期末在庫", -1)は前日の期末在庫
+    """
+    row: str
+    offset: int = 0
+
+    def collect_refs(self, refs: Dict[Ref, None]) -> None:
+        refs[self] = None
+
+    def source(self, names: Dict[Ref, str]) -> str:
+        return names[self]
+
+    def __str__(self) -> str:
+        if self.offset == 0:
+            return f"{self.row}[t]"
+        return f"{self.row}[t{self.offset:+d}]"
+
+
+class Literal(Expr):
+    def __init__(self, value: Union[float, int]) -> None:
+        self.value = value
+
+    def source(self, names: Dict[Ref, str]) -> str:
+        if not math.isfinite(self.value):
+            # infやnanは、そのままではPythonの式として読めない
+            return f"float('{self.value!r}')"
+        return repr(self.value)
+
+
+class BinOp(Expr):
+    def __init__(self, op: str, left: Expr, right: Expr) -> None:
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def collect_refs(self, refs: Dict[Ref, None]) -> None:
+        self.left.collect_refs(refs)
+        self.right.collect_refs(refs)
+
+    def source(self, names: Dict[Ref, str]) -> str:
+        return f"({self.left.source(names)} {self.op} {self.right.source(names)})"
+
+
+def _wrap(v: Operand) -> Expr:
+    if isinstance(v, Expr):
+        return v
+    return Literal(v)
+
+
+class RowFormula:
+    """
+    1行分のセルで共有する式。参照するセルの値を位置引数に取る関数にコンパイルする
+    """
+
+    def __init__(self, expr: Expr) -> None:
+        refs: Dict[Ref, None] = {}
+        expr.collect_refs(refs)
+        self.expr = expr
+        self.refs: List[Ref] = list(refs)
+        names = {r: f"x{i}" for i, r in enumerate(self.refs)}
+        params = ", ".join(names.values())
+        self.source = f"lambda {params}: {expr.source(names)}"
+        self.func: Callable[..., Any] = eval(
+            compile(self.source, "<row formula>", "eval"))
+
+    def __str__(self) -> str:
+        names = {r: str(r) for r in self.refs}
+        return self.expr.source(names)
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Dict, Generic, Optional, Tuple, TypeVar
+
+import numpy as np
+
+from .task import Task
+from .ticks import Date, Month, Week
+from .value_task import CellValue, ValueTask, overlay, same_value
+from . import dependency_graph
+
+if TYPE_CHECKING:
+    from .sheet import Sheet
+
+
+Tick = TypeVar("Tick", Date, Week, Month)
+
+
+class Scenario(Generic[Tick]):
+    """
+    シートの一部のセルの値だけを差し替えた、what-if用の分岐
+
+    元のシートの計算グラフと計算結果をそのまま共有し、差し替えたセルと、
+    それによって値が変わるタスクの値だけを自分で持つ
+    元のシートは計算済みであること
+    """
+
+    def __init__(self, base: Sheet[Tick]) -> None:
+        self.base: Sheet[Tick] = base
+        self.overrides: Dict[Task, Any] = {}
+        # 元のシートと値が違うタスクの値
+        self.values: Dict[Task, Any] = {}
+        self._dirty = False
+
+    def __setitem__(self, pair: Tuple[str, Tick], v: Any) -> None:
+        self.set(self.base[pair], v)
+
+    def set(self, node: CellValue, v: Any) -> None:
+        self.overrides[node] = v
+        self._dirty = True
+
+    def __getitem__(self, pair: Tuple[str, Tick]) -> Any:
+        return self.get(self.base[pair])
+
+    def get(self, node: ValueTask) -> Any:
+        self.calculate()
+        if node in self.values:
+            return self.values[node]
+        return node.value
+
+    def calculate(self) -> None:
+        """
+        差し替えたセルの子孫だけを、位相順に計算し直す
+        親の値が元のシートと同じタスクは、計算せずに元の値を使う
+        """
+        if not self._dirty:
+            return
+        g = dependency_graph.get()
+        values: Dict[Task, Any] = dict(self.overrides)
+        with overlay(values):
+            for t in g.get_descendants(self.overrides):
+                if t in self.overrides or not isinstance(t, ValueTask):
+                    continue
+                if not any(p in values for p in g.get_parents(t)):
+                    continue
+                v = t.compute()
+                if not (t.done and same_value(t._value, v)):
+                    values[t] = v
+        self.values = values
+        self._dirty = False
+
+    def get_values(self) -> np.ndarray:
+        """
+        Sheet.get_values(as_array=True)と同じ形で、このシナリオの値を返す
+        """
+        self.calculate()
+        ret = self.base.get_values(as_array=True)
+        for i, j, cell in self.base.iter_cells():
+            if cell.value in self.values:
+                ret[i, j] = self.values[cell.value]
+        return ret
+
+    def diff(self, other: Optional[Scenario[Tick]] = None
+             ) -> Dict[Tuple[str, str], Tuple[Any, Any]]:
+        """
+        値が違うセルについて、(行, 列)から(otherの値, このシナリオの値)への辞書を返す
+        otherを省略すると、元のシートと比べる
+        """
+        self.calculate()
+        nodes: Dict[Task, None] = dict.fromkeys(self.values)
+        if other is not None:
+            other.calculate()
+            nodes.update(dict.fromkeys(other.values))
+
+        ret: Dict[Tuple[str, str], Tuple[Any, Any]] = {}
+        for n in nodes:
+            if not isinstance(n, CellValue):
+                continue
+            before = n.value if other is None else other.get(n)
+            after = self.get(n)
+            if not same_value(before, after):
+                ret[(n.cell.row, n.cell.col)] = (before, after)
+        return ret
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import socketserver
+import threading
+import time
+from typing import Any, Deque, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from .exceptions import InvalidData
+from .sheet import Sheet
+
+
+class ReadWriteLock:
+    """
+    読み込みは同時に何件でも、書き込みは1件だけ行えるロック
+    書き込みを待っている間は、新しい読み込みを待たせる
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._cond:
+            while self._writing or self._waiting_writers > 0:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writing or self._readers > 0:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class LatencyStats:
+    """
+    要求の種類ごとの処理時間。直近のwindow件から分位点を求める
+    """
+
+    def __init__(self, window: int = 1024) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._count: Dict[str, int] = {}
+        self._recent: Dict[str, Deque[float]] = {}
+
+    def record(self, kind: str, seconds: float) -> None:
+        with self._lock:
+            self._count[kind] = self._count.get(kind, 0) + 1
+            self._recent.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            ret = {}
+            for kind, recent in self._recent.items():
+                xs = sorted(recent)
+                ret[kind] = {
+                    "count": self._count[kind],
+                    "mean_ms": sum(xs) / len(xs) * 1000,
+                    "p50_ms": xs[len(xs) // 2] * 1000,
+                    "p99_ms": xs[min(len(xs) - 1, len(xs) * 99 // 100)] * 1000,
+                    "max_ms": xs[-1] * 1000,
+                }
+            return ret
+
+
+def _json_value(v: Any) -> Any:
+    v = float(v)
+    return None if math.isnan(v) else v
+
+
+class SheetServer:
+    """
+    計算済みのシートをメモリに持ち続け、書き換えと読み込みの要求に答える
+
+    要求はJSONで、次の項目を持つ
+      updates: [{"sheet", "row", "col", "value"}, ...]  まとめて書き換えて差分だけ再計算する
+      reads: [{"sheet", "row"?, "col"?}, ...]  セル、行、シート全体の値を読む
+      metrics: true  処理時間の統計を返す
+    応答は、再計算したセル(changed)、読んだ値(values)、処理時間(latency_ms)を持つ
+    """
+
+    def __init__(self, sheets: Mapping[str, Sheet]) -> None:
+        self.sheets = dict(sheets)
+        self.lock = ReadWriteLock()
+        self.stats = LatencyStats()
+
+    def handle(self, request: Any) -> Dict[str, Any]:
+        begin = time.perf_counter()
+        ret: Dict[str, Any] = {}
+        try:
+            if not isinstance(request, Mapping):
+                raise InvalidData("a request must be a JSON object")
+            updates = request.get("updates", [])
+            reads = request.get("reads", [])
+            if len(updates) > 0:
+                kind = "update"
+                with self.lock.write():
+                    ret["changed"] = self._update(updates)
+                    ret["values"] = [self._read(r) for r in reads]
+            else:
+                kind = "read"
+                with self.lock.read():
+                    ret["values"] = [self._read(r) for r in reads]
+        except Exception as e:
+            kind = "error"
+            ret = {"error": f"{type(e).__name__}: {e}"}
+        elapsed = time.perf_counter() - begin
+        self.stats.record(kind, elapsed)
+        ret["latency_ms"] = elapsed * 1000
+        if isinstance(request, Mapping) and request.get("metrics"):
+            ret["metrics"] = self.stats.snapshot()
+        return ret
+
+    def _update(self, updates: List[Mapping[str, Any]]) -> List[Dict[str, Any]]:
+        by_sheet: Dict[str, List[Tuple[str, str, float]]] = {}
+        for u in updates:
+            by_sheet.setdefault(u["sheet"], []).append((u["row"], u["col"], u["value"]))
+        ret = []
+        for name, changes in by_sheet.items():
+            for cell in self.sheets[name].update_many(changes):
+                ret.append({
+                    "sheet": name, "row": cell.row, "col": cell.col,
+                    "value": _json_value(cell.value.peek(math.nan)),
+                })
+        return ret
+
+    def _read(self, r: Mapping[str, Any]) -> Any:
+        sheet = self.sheets[r["sheet"]]
+        if "row" not in r:
+            return [[_json_value(v) for v in row] for row in sheet.get_values(as_array=True)]
+        if "col" not in r:
+            return [_json_value(v) for v in sheet.get_row_values(r["row"])]
+        # 読み込みでセルを作らないよう、作られているセルだけを引く
+        key = sheet.col_index[sheet.tick_class.from_str(r["col"])]
+        cell = sheet.cells[sheet.row_index[r["row"]]].get(key)
+        if cell is None:
+            return None
+        return _json_value(cell.value.peek(math.nan))
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+    """
+    1行に1つのJSONの要求を読み、1行のJSONで答える。接続は使い回せる
+    """
+    server: Any
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response: Dict[str, Any] = {"error": f"invalid json: {e}"}
+            else:
+                response = self.server.sheet_server.handle(request)
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    """
+    POST / に要求のJSONを送ると、応答のJSONを返す。GET /metrics で処理時間の統計を返す
+    """
+    protocol_version = "HTTP/1.1"
+    server: Any
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self._send(400, {"error": f"invalid json: {e}"})
+            return
+        response = self.server.sheet_server.handle(request)
+        self._send(400 if "error" in response else 200, response)
+
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self._send(404, {"error": "not found"})
+            return
+        self._send(200, self.server.sheet_server.stats.snapshot())
+
+    def _send(self, status: int, body: Any) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_unix_server(sheet_server: SheetServer, path: str) -> socketserver.BaseServer:
+    ret = _UnixServer(path, _StreamHandler)
+    ret.sheet_server = sheet_server  # type: ignore
+    return ret
+
+
+def make_http_server(sheet_server: SheetServer, host: str = "127.0.0.1",
+                     port: int = 8000) -> socketserver.BaseServer:
+    ret = ThreadingHTTPServer((host, port), _HTTPHandler)
+    ret.daemon_threads = True
+    ret.sheet_server = sheet_server  # type: ignore
+    return ret
+
+
+def serve(sheet_server: SheetServer, socket_path: Optional[str] = None,
+          host: str = "127.0.0.1", port: int = 8000) -> None:
+    """
+    socket_pathを指定するとUnixソケットで、そうでなければHTTPで要求を待ち続ける
+    """
+    if socket_path is not None:
+        server = make_unix_server(sheet_server, socket_path)
+    else:
+        server = make_http_server(sheet_server, host, port)
+    with server:
+        server.serve_forever()
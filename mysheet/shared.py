@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import json
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import struct
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .exceptions import InvalidData
+
+if TYPE_CHECKING:
+    from .sheet import Sheet
+
+
+MAGIC = b"MYSHEET1"
+# magic, version, nrow, ncol, メタデータ(JSON)のバイト数
+HEADER = struct.Struct("<8sQIII")
+VERSION = struct.Struct("<Q")
+VERSION_OFFSET = 8
+
+
+def _data_offset(meta_len: int) -> int:
+    n = HEADER.size + meta_len
+    return (n + 7) // 8 * 8
+
+
+class SharedSheetPublisher:
+    """
+    シートの値を共有メモリに書き出し、他のプロセスから読めるようにする
+
+    共有メモリの先頭には、形、行名、列の範囲と版番号を置く
+    版番号は書き込み中だけ奇数になるので、読み手は前後の版番号を比べれば
+    書き込み途中の値を読んでいないことを確かめられる
+    """
+
+    def __init__(self, sheet: Sheet, name: Optional[str] = None) -> None:
+        self.sheet = sheet
+        meta = json.dumps({
+            "rows": list(sheet.row_names),
+            "columns": list(sheet.col_names),
+            "start": str(sheet.start),
+            "end": str(sheet.end),
+        }).encode("utf-8")
+        offset = _data_offset(len(meta))
+        self.shm = SharedMemory(
+            name=name, create=True,
+            size=offset + sheet.nrow * sheet.ncol * 8)
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, 0,
+                         sheet.nrow, sheet.ncol, len(meta))
+        self.shm.buf[HEADER.size:HEADER.size + len(meta)] = meta
+        self.array: np.ndarray = np.ndarray(
+            (sheet.nrow, sheet.ncol), dtype=np.float64,
+            buffer=self.shm.buf, offset=offset)
+        self.publish()
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def version(self) -> int:
+        return VERSION.unpack_from(self.shm.buf, VERSION_OFFSET)[0]
+
+    def publish(self) -> None:
+        values = self.sheet.get_values(as_array=True)
+        if values.shape != self.array.shape:
+            raise InvalidData(
+                f"{self.name}: the sheet was resized, call Sheet.share again")
+        v = self.version
+        VERSION.pack_into(self.shm.buf, VERSION_OFFSET, v + 1)
+        self.array[:] = values
+        VERSION.pack_into(self.shm.buf, VERSION_OFFSET, v + 2)
+
+    def close(self) -> None:
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedSheetReader:
+    """
+    SharedSheetPublisherが書き出したシートの値を、コピーせずに参照する
+    """
+
+    def __init__(self, name: str) -> None:
+        self.shm = _attach(name)
+        magic, _, nrow, ncol, meta_len = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC:
+            self.shm.close()
+            raise InvalidData(f"{name} is not a shared sheet")
+        meta: Dict[str, Any] = json.loads(
+            bytes(self.shm.buf[HEADER.size:HEADER.size + meta_len]))
+        self.row_names: Sequence[str] = meta["rows"]
+        self.col_names: Sequence[str] = meta["columns"]
+        self.start: str = meta["start"]
+        self.end: str = meta["end"]
+        # 書き込み中にも変わりうる、共有メモリそのものの配列
+        self.array: np.ndarray = np.ndarray(
+            (nrow, ncol), dtype=np.float64,
+            buffer=self.shm.buf, offset=_data_offset(meta_len))
+
+    @property
+    def version(self) -> int:
+        return VERSION.unpack_from(self.shm.buf, VERSION_OFFSET)[0]
+
+    def snapshot(self, timeout: float = 1.0) -> Tuple[int, np.ndarray]:
+        """
+        書き込みの途中でない時点の値を、版番号と一緒にコピーして返す
+        書き込み中なら少し待って読み直し、timeout秒経っても読めなければTimeoutErrorを出す
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            before = self.version
+            if before % 2 == 0:
+                values = self.array.copy()
+                if self.version == before:
+                    return before, values
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{self.shm.name}: the publisher keeps writing")
+            # 書き手に処理を譲る
+            time.sleep(0)
+
+    def row(self, name: str) -> np.ndarray:
+        return self.array[self.row_names.index(name)]
+
+    def close(self) -> None:
+        del self.array
+        self.shm.close()
+
+
+def _attach(name: str) -> SharedMemory:
+    try:
+        return SharedMemory(name=name, track=False)  # type: ignore
+    except TypeError:
+        # Python 3.12以前は、読み手の終了時に共有メモリが消されないよう登録を外す
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+        return shm
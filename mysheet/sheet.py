@@ -1,12 +1,23 @@
-from collections import deque
+from __future__ import annotations
+
 from io import FileIO
-from typing import Deque, Generator, Generic, Mapping, Sequence, Set, Tuple, TypeVar, Union, overload
+import math
+from typing import TYPE_CHECKING, Dict, Generator, Generic, Iterator, List, Literal, Optional, Sequence, Tuple, TypeVar, Union, cast, overload
+import warnings
 
-from .exceptions import NotEvaluated
-from .task import Task
-from .value_task import Cell, CellValue, Constant, ValueArray, ValueTask
+from .exceptions import CyclicDependency, NotEvaluated
+from .row_formula import Expr, RowFormula
+from .dependency_graph import num_children
+from .value_task import Cell, CellState, CellValue, Constant, ValueArray, ValueTask
 from .ticks import Date, Week, Month
-from . import dependency_graph
+from . import dependency_graph, fusion
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from .scenario import Scenario
+    from .shared import SharedSheetPublisher
+    from .task import Task
 
 
 Tick = TypeVar("Tick", Date, Week, Month)
@@ -22,17 +33,21 @@ class Sheet(Generic[Tick]):
         self.ncol = end - start + 1
         self.row_names = row_names
         self.nrow = len(row_names)
-        self.cells = [
-            [Cell(row_names[r],
-                  str(start + c)) for c in range(self.ncol)]
-            for r in range(self.nrow)
-        ]
-        self.col_index: Mapping[Tick, int] = {
+        # 行ごとの、列番号からセルへの辞書。セルは最初に使われたときに作る
+        self.cells: List[Dict[int, Cell]] = [{} for _ in range(self.nrow)]
+        # 列からセルの辞書のキーへの対応。古い列を捨ててもキーは変わらない
+        self.col_index: Dict[Tick, int] = {
             start + i: i for i in range(self.ncol)
         }
+        # startの列のキー
+        self._base = 0
         self.row_index = {
             self.row_names[i]: i for i in range(self.nrow)
         }
+        self.row_formulas: Dict[str, Tuple[RowFormula, Optional[Tick], Optional[Tick]]] = {}
+        # 捨てた列のうち、まだ残っている列から参照されているセル
+        self._frozen: List[Cell] = []
+        self._publisher: Optional["SharedSheetPublisher"] = None
 
     @overload
     def __getitem__(self, pair: Tuple[str, Tick]) -> CellValue:
@@ -47,15 +62,15 @@ class Sheet(Generic[Tick]):
         p1 = pair[1]
         if isinstance(p1, list):
             return ValueArray([
-                self.cells[row][c].value
+                self.cell(row, c).value
                 for c in [
-                    self.col_index[x]
+                    self._col(x)
                     for x in p1
                 ]
             ])
         else:
-            col = self.col_index[p1]
-            return self.cells[row][col].value
+            col = self._col(p1)
+            return self.cell(row, col).value
 
     def __setitem__(self, pair: Tuple[str, Tick], v: Union[ValueTask[float], float, int]):
         if not isinstance(v, ValueTask):
@@ -63,8 +78,113 @@ class Sheet(Generic[Tick]):
         else:
             v2 = v
         r = self.row_index[pair[0]]
-        c = self.col_index[pair[1]]
-        self.cells[r][c].formula = v2
+        c = self._col(pair[1])
+        self.cell(r, c).formula = v2
+
+    def cell(self, r: int, c: int) -> Cell:
+        """
+        r行目、startからc列目のセル。まだなければ作る
+        """
+        row = self.cells[r]
+        ret = row.get(c + self._base)
+        if ret is None:
+            ret = Cell(self.row_names[r], str(self.start + c))
+            row[c + self._base] = ret
+        return ret
+
+    def iter_cells(self) -> Iterator[Tuple[int, int, Cell]]:
+        """
+        作られているセルだけを、(行番号, 列番号, セル)の組で返す
+        """
+        for r, row in enumerate(self.cells):
+            for c, cell in row.items():
+                yield r, c - self._base, cell
+
+    def set_row_formula(self, row: str, expr: Expr,
+                        start: Optional[Tick] = None,
+                        end: Optional[Tick] = None) -> None:
+        """
+        行全体に、列の位置からの相対参照で書いた式を設定する
+
+            sheet.set_row_formula("期初在庫", Ref("期末在庫", -1), start=START + 1)
+
+        式は行ごとに1つだけ持ち、各セルには参照先のセルからの辺だけを張る
+        startとendで列の範囲を絞れる。参照先がシートの外になる列は設定しない
+        """
+        f = RowFormula(expr)
+        self._apply_row_formula(row, f, *self._col_range(start, end))
+        self.row_formulas[row] = (f, start, end)
+
+    def _apply_row_formula(self, row: str, f: RowFormula, lo: int, hi: int) -> None:
+        r = self.row_index[row]
+        refs = [(self.row_index[ref.row], ref.offset) for ref in f.refs]
+        g = dependency_graph.get()
+        auto_collect = g.auto_collect
+        # 途中の列で循環が見つかったら行全体を元に戻すので、それまで古い式は回収しない
+        g.auto_collect = False
+        done: List[Tuple[Cell, CellState]] = []
+        try:
+            for c in range(lo, hi):
+                if any(not 0 <= c + offset < self.ncol for _, offset in refs):
+                    continue
+                sources = [self.cell(rr, c + offset).value for rr, offset in refs]
+                cell = self.cell(r, c)
+                state = cell.save()
+                cell.set_row_formula(f, sources)
+                done.append((cell, state))
+        except CyclicDependency:
+            for cell, state in reversed(done):
+                cell.restore(state)
+            raise
+        finally:
+            g.auto_collect = auto_collect
+            if auto_collect:
+                g.collect()
+
+    def fork(self) -> Scenario[Tick]:
+        """
+        このシートを元に、一部のセルの値を差し替えて比べるためのシナリオを作る
+        """
+        from .scenario import Scenario
+        return Scenario(self)
+
+    def goal_seek(self, target: Union[Tuple[str, Tick], Sequence[Tuple[str, Tick]]],
+                  goal: float, inputs: Sequence[Tuple[str, Tick]],
+                  lo: float, hi: float, **kwargs) -> float:
+        """
+        inputsのセルに同じ値を入れて、targetのセル(複数ならその最小値)がgoalになる値を探す
+        計算済みのシートで使う。solver.goal_seekを参照
+        """
+        from . import solver
+        return solver.goal_seek(
+            self, self._nodes(target), goal, self._nodes(inputs), lo, hi, **kwargs)
+
+    def optimize(self, target: Union[Tuple[str, Tick], Sequence[Tuple[str, Tick]]],
+                 inputs: Sequence[Tuple[str, Tick]],
+                 bounds: Sequence[Tuple[float, float]], **kwargs
+                 ) -> Tuple[np.ndarray, float]:
+        """
+        targetのセル(複数ならその合計)を最小にするinputsの値を探す
+        計算済みのシートで使う。solver.optimizeを参照
+        """
+        from . import solver
+        return solver.optimize(
+            self, self._nodes(target), self._nodes(inputs), bounds, **kwargs)
+
+    def sensitivities(self, outputs: Union[Tuple[str, Tick], Sequence[Tuple[str, Tick]]],
+                      inputs: Sequence[Tuple[str, Tick]]) -> np.ndarray:
+        """
+        outputsのセルの、inputsのセルについての微分を(出力の数 x 入力の数)の配列で返す
+        計算済みのシートで使う。solver.jacobianを参照
+        """
+        from . import solver
+        return solver.jacobian(self, self._nodes(outputs), self._nodes(inputs))
+
+    def _nodes(self, pairs: Union[Tuple[str, Tick], Sequence[Tuple[str, Tick]]]
+               ) -> List[CellValue]:
+        if isinstance(pairs, tuple) and isinstance(pairs[0], str):
+            return [self[cast(Tuple[str, Tick], pairs)]]
+        return [self[p] for p in cast(Sequence[Tuple[str, Tick]], pairs)]
 
     @property
     def columns(self) -> Sequence[Tick]:
@@ -75,72 +195,192 @@ class Sheet(Generic[Tick]):
         return [str(c) for c in self.columns]
 
     def calculate(self) -> None:
-        dependency_graph.get().calculate()
+        try:
+            dependency_graph.get().calculate()
+        finally:
+            # 一部のタスクが失敗しても、計算できた値は書き出す
+            self._publish()
+
+    def fuse(self) -> int:
+        """
+        演算子のノードの連なりを1つのノードにまとめる。fusion.fuseを参照
+        """
+        return fusion.fuse(dependency_graph.get())
 
+    def calculate_parallel(self, processes: Optional[int] = None) -> None:
+        """
+        互いに関係しない部分を、プロセスごとに並列に計算する
+        """
+        try:
+            dependency_graph.get().calculate_parallel(processes)
+        finally:
+            self._publish()
+
+    async def calculate_async(self, concurrency: Optional[int] = None) -> None:
+        await dependency_graph.get().calculate_async(concurrency)
+        self._publish()
+
+    def share(self, name: Optional[str] = None) -> "SharedSheetPublisher":
+        """
+        値を共有メモリに書き出し、calculateやupdateのたびに更新する
+        他のプロセスからは、SharedSheetReader(name)で読める
+        """
+        from .shared import SharedSheetPublisher
+        self._publisher = SharedSheetPublisher(self, name)
+        return self._publisher
+
+    def _publish(self) -> None:
+        if self._publisher is not None:
+            self._publisher.publish()
+
+    def _detach_publisher(self) -> None:
+        """
+        形が変わると共有メモリの配列に収まらないので、書き出しをやめる
+        """
+        if self._publisher is None:
+            return
+        warnings.warn(
+            f"{self._publisher.name}: the sheet was resized and is no longer "
+            "published, call Sheet.share again", RuntimeWarning)
+        self._publisher = None
+
+    @overload
     def get_values(self) -> Sequence[Sequence[float]]:
-        return [
-            [self[r, c].value for c in self.columns]
-            for r in self.row_names
-        ]
+        ...
+
+    @overload
+    def get_values(self, as_array: Literal[True],
+                   start: Optional[Tick] = None,
+                   end: Optional[Tick] = None) -> np.ndarray:
+        ...
+
+    def get_values(self, as_array=False, start=None, end=None):
+        """
+        全セルの値を返す
+        as_array=Trueのときは、行×列のfloat64の配列を返す。startとendで
+        列の範囲を絞れる。空のセルや未計算のセルはNaNになる
+        """
+        if not as_array:
+            return [
+                [self[r, c].value for c in self.columns]
+                for r in self.row_names
+            ]
+        import numpy as np
+        lo, hi = self._col_range(start, end)
+        ret = np.full((self.nrow, hi - lo), np.nan)
+        for i, row in enumerate(self.cells):
+            _fill(ret[i], row, lo + self._base, hi + self._base)
+        return ret
+
+    def get_row_values(self, row: str,
+                       start: Optional[Tick] = None,
+                       end: Optional[Tick] = None) -> np.ndarray:
+        """
+        1行分の値をfloat64の配列で返す。空のセルや未計算のセルはNaNになる
+        """
+        import numpy as np
+        lo, hi = self._col_range(start, end)
+        ret = np.full(hi - lo, np.nan)
+        _fill(ret, self.cells[self.row_index[row]], lo + self._base, hi + self._base)
+        return ret
+
+    def get_col_values(self, column: Union[str, Tick]) -> np.ndarray:
+        """
+        1列分の値を、行の順にfloat64の配列で返す
+        """
+        import numpy as np
+        c = self.col_index[self._tick(column)]
+        return np.fromiter(
+            (_peek(row.get(c)) for row in self.cells),
+            dtype=np.float64, count=self.nrow)
+
+    def _col(self, column: Tick) -> int:
+        return self.col_index[column] - self._base
+
+    def _col_range(self, start: Optional[Tick], end: Optional[Tick]) -> Tuple[int, int]:
+        lo = 0 if start is None else max(0, start - self.start)
+        hi = self.ncol if end is None else self._col(end) + 1
+        return lo, hi
+
+    def _tick(self, column: Union[str, Tick]) -> Tick:
+        if isinstance(column, str):
+            return self.tick_class.from_str(column)
+        return column
+
+    def _cell_values(self, row: str, column: Optional[Union[str, Tick]]) -> Sequence[CellValue]:
+        if column is None:
+            return [c.value for c in self.cells[self.row_index[row]].values()]
+        return [self[row, self._tick(column)]]
 
     def get_parent_cells(self, row: str, _column: Union[str, Tick]) -> Generator[Cell, None, None]:
-        if isinstance(_column, str):
-            column = self.tick_class.from_str(_column)
-        else:
-            column = _column
-        node = self[row, column]
-        g = dependency_graph.get()
-        visited: Set[Task] = set()
-        stack: Deque[Task] = deque()
-        stack.append(node)
-        while len(stack) > 0:
-            current = stack.pop()
-            parents = g.get_parents(current)
-            for p in parents:
-                if p in visited:
-                    continue
-                visited.add(p)
-                if isinstance(p, CellValue):
-                    yield p.cell
-                else:
-                    stack.append(p)
+        node = self[row, self._tick(_column)]
+        lineage = dependency_graph.get().lineage
+        for p in lineage.get_parents(node):
+            yield p.cell  # type: ignore
 
     def get_child_cells(self, row: str, _column: Union[str, Tick]) -> Generator[Cell, None, None]:
-        if isinstance(_column, str):
-            column = self.tick_class.from_str(_column)
-        else:
-            column = _column
-        node = self[row, column]
-        g = dependency_graph.get()
-        visited: Set[Task] = set()
-        stack: Deque[Task] = deque()
-        stack.append(node)
-        while len(stack) > 0:
-            current = stack.pop()
-            children = g.get_children(current)
-            for c in children:
-                if c in visited:
-                    continue
-                visited.add(c)
-                if isinstance(c, CellValue):
-                    yield c.cell
-                else:
-                    stack.append(c)
+        node = self[row, self._tick(_column)]
+        lineage = dependency_graph.get().lineage
+        for c in lineage.get_children(node):
+            yield c.cell  # type: ignore
+
+    def get_ancestor_cells(self, row: str,
+                           column: Optional[Union[str, Tick]] = None,
+                           depth: Optional[int] = None) -> Sequence[Cell]:
+        """
+        セルが間接的に参照しているセルを、近い順に返す
+        columnを省略すると、行全体の祖先をまとめて求める
+        depthを指定すると、その段数までで打ち切る
+        """
+        lineage = dependency_graph.get().lineage
+        nodes = lineage.ancestors(self._cell_values(row, column), depth)
+        return [n.cell for n in nodes]  # type: ignore
+
+    def get_descendant_cells(self, row: str,
+                             column: Optional[Union[str, Tick]] = None,
+                             depth: Optional[int] = None) -> Sequence[Cell]:
+        """
+        セルの値を間接的に参照しているセルを、近い順に返す
+        引数の意味はget_ancestor_cellsと同じ
+        """
+        lineage = dependency_graph.get().lineage
+        nodes = lineage.descendants(self._cell_values(row, column), depth)
+        return [n.cell for n in nodes]  # type: ignore
 
     def update(self, row: str, _column: Union[str, Tick], value: float) -> Sequence[Cell]:
-        if isinstance(_column, str):
-            column = self.tick_class.from_str(_column)
-        else:
-            column = _column
-        cellVal: CellValue = self[row, column]   # type: ignore
+        cellVal: CellValue = self[row, self._tick(_column)]   # type: ignore
         cell = cellVal.cell
         cell.formula = Constant(value)
         g = dependency_graph.get()
-        ret = g.update(cell.formula)
+        try:
+            ret = g.update(cellVal)
+        finally:
+            self._publish()
+        return [c.cell for c in ret if isinstance(c, CellValue)]
+
+    def update_many(self, changes: Sequence[Tuple[str, Union[str, Tick], float]]
+                    ) -> Sequence[Cell]:
+        """
+        (行, 列, 値)の組をまとめて書き換えてから、影響を受けるセルを1回だけ再計算する
+        再計算したセルを返す
+        """
+        # 途中で失敗しても一部だけが書き換わらないよう、先にすべてのセルと値を確かめる
+        resolved: List[Tuple[CellValue, float]] = [
+            (self[row, self._tick(column)], float(value))   # type: ignore
+            for row, column, value in changes
+        ]
+        for cellVal, value in resolved:
+            cellVal.cell.formula = Constant(value)
+        try:
+            ret = dependency_graph.get().update_many([c for c, _ in resolved])
+        finally:
+            self._publish()
         return [c.cell for c in ret if isinstance(c, CellValue)]
 
     def to_csv(self, fp):
-        def filter(cell: Cell) -> str:
+        def filter(cell: Optional[Cell]) -> str:
+            if cell is None:
+                return ""
             try:
                 v = cell.result
             except NotEvaluated:
@@ -152,9 +392,153 @@ class Sheet(Generic[Tick]):
         fp.write("\t".join([""] + [str(d) for d in self.columns]) + "\n")
         for i, rn in enumerate(self.row_names):
             fp.write(rn + "\t")
-            fp.write("\t".join([filter(v) for v in self.cells[i]]))
+            row = self.cells[i]
+            fp.write("\t".join([
+                filter(row.get(c + self._base)) for c in range(self.ncol)]))
             fp.write("\n")
 
+    def to_dot(self, path: str, collapse: bool = False,
+               around: Optional[Tuple[str, Union[str, Tick]]] = None,
+               depth: Optional[int] = None) -> None:
+        """
+        セル同士の依存関係をDOT形式で書き出す
+
+        collapse=Trueのとき、同じ行のセルを1つの節点にまとめ、辺には
+        列のずれ("t", "t-1"など)をラベルとして付ける
+        aroundに(行, 列)を指定すると、そのセルからdepth段以内の
+        祖先と子孫だけを書き出す
+        """
+        lineage = dependency_graph.get().lineage
+        if around is None:
+            values: Sequence[CellValue] = [
+                c.value for _, _, c in self.iter_cells()]
+        else:
+            center = self[around[0], self._tick(around[1])]
+            values = [center] + \
+                lineage.ancestors([center], depth) + \
+                lineage.descendants([center], depth)  # type: ignore
+        targets = set(values)
+
+        if not collapse:
+            dependency_graph.write_dot(
+                path,
+                ((p.cell.name, v.cell.name, None)  # type: ignore
+                 for v in values
+                 for p in lineage.get_parents(v) if p in targets),
+                (v.cell.name for v in values)
+            )
+            return
+
+        position: Dict[Task, int] = {c.value: i for _, i, c in self.iter_cells()}
+        edges: Dict[Tuple[str, str, str], None] = {}
+        for v in values:
+            for p in lineage.get_parents(v):
+                if p not in targets:
+                    continue
+                if p in position:
+                    offset = position[p] - position[v]
+                    label = "t" if offset == 0 else f"t{offset:+d}"
+                else:
+                    # 別のシートのセル
+                    label = "?"
+                edges[(p.cell.row, v.cell.row, label)] = None  # type: ignore
+        dependency_graph.write_dot(
+            path,
+            edges.keys(),
+            dict.fromkeys(v.cell.row for v in values).keys()
+        )
+
+    def save_checkpoint(self, path: str) -> None:
+        """
+        入力値と計算結果をファイルに保存する。checkpoint.saveを参照
+        """
+        from . import checkpoint
+        checkpoint.save(self, path)
+
+    def restore_checkpoint(self, path: str) -> Sequence[Cell]:
+        """
+        保存した計算結果を戻し、入力が変わったセルだけを計算し直す
+        checkpoint.restoreを参照
+        """
+        from . import checkpoint
+        return checkpoint.restore(self, path)
+
+    def extend(self, n: int) -> None:
+        """
+        右端にn列を追加し、終わりを指定していない行の式を新しい列にも設定する
+        """
+        if n <= 0:
+            return
+        self._detach_publisher()
+        old = self.ncol
+        for i in range(n):
+            self.col_index[self.end + 1 + i] = self._base + old + i
+        self.end = self.end + n
+        self.ncol += n
+        for row, (f, start, end) in self.row_formulas.items():
+            if end is not None:
+                continue
+            # 右側を参照していて、これまで設定できなかった列も含める
+            ahead = max([0] + [ref.offset for ref in f.refs])
+            lo, _ = self._col_range(start, None)
+            self._apply_row_formula(row, f, max(lo, old - ahead), self.ncol)
+
+    def retire_before(self, column: Tick) -> None:
+        """
+        columnより前の列を捨てる
+
+        捨てる列のセルは計算した値の定数に置き換えてから、計算グラフから取り除く
+        残る列から参照されているセルだけは、定数として計算グラフに残す
+        """
+        k = min(column - self.start, self.ncol)
+        if k <= 0:
+            return
+        self._detach_publisher()
+        g = dependency_graph.get()
+        retired: List[Cell] = []
+        for row in self.cells:
+            for key in range(self._base, self._base + k):
+                cell = row.pop(key, None)
+                if cell is not None and not cell.empty:
+                    retired.append(cell)
+
+        for cell in retired:
+            g.evaluate(cell.value)
+        for cell in retired:
+            v = cell.value.value
+            cell.formula = Constant(v)
+
+        frozen: List[Cell] = []
+        for cell in self._frozen + retired:
+            if cell.value not in g.graph:
+                continue
+            if num_children(g.graph, cell.value) > 0:
+                frozen.append(cell)
+            else:
+                g.remove_dependency(cell.formula, cell.value)
+        self._frozen = frozen
+
+        for i in range(k):
+            del self.col_index[self.start + i]
+        self.start = self.start + k
+        self._base += k
+        self.ncol -= k
+
     def get_row(self, row: str) -> Sequence[Cell]:
+        """
+        1行分のセルを返す。まだないセルはここで作られる
+        """
         idx = self.row_index[row]
-        return self.cells[idx]
+        return [self.cell(idx, c) for c in range(self.ncol)]
+
+
+def _peek(cell: Optional[Cell]) -> float:
+    if cell is None:
+        return math.nan
+    return cell.value.peek(math.nan)
+
+
+def _fill(out: np.ndarray, row: Dict[int, Cell], lo: int, hi: int) -> None:
+    for c, cell in row.items():
+        if lo <= c < hi:
+            out[c - lo] = cell.value.peek(math.nan)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Callable, Sequence, Tuple, TypeVar
+
+import numpy as np
+
+from .dual import Dual
+from .exceptions import NoSolution
+from .scenario import Scenario
+from .ticks import Date, Month, Week
+from .value_task import CellValue
+
+if TYPE_CHECKING:
+    from .sheet import Sheet
+
+
+Tick = TypeVar("Tick", Date, Week, Month)
+
+
+def probe(sheet: Sheet[Tick], inputs: Sequence[CellValue],
+          candidates: np.ndarray, outputs: Sequence[CellValue]) -> np.ndarray:
+    """
+    入力のセルinputsの値をcandidates(候補の数 x 入力の数)の各行に差し替えたときの、
+    出力のセルoutputsの値を(候補の数 x 出力の数)の配列で返す
+
+    まず各入力に候補の数だけの配列を入れて、すべての候補を1回で計算する
+    配列を扱えないタスクがあれば、候補ごとのシナリオで計算し直す
+    どちらも、入力の子孫だけを計算する
+    """
+    candidates = np.asarray(candidates, dtype=np.float64)
+    k = len(candidates)
+    scenario = Scenario(sheet)
+    for j, node in enumerate(inputs):
+        scenario.set(node, candidates[:, j])
+    try:
+        return np.stack([
+            np.broadcast_to(np.asarray(scenario.get(o), dtype=np.float64), (k,))
+            for o in outputs
+        ], axis=1)
+    except Exception:
+        pass
+
+    ret = np.empty((k, len(outputs)), dtype=np.float64)
+    for i in range(k):
+        scenario = Scenario(sheet)
+        for j, node in enumerate(inputs):
+            scenario.set(node, float(candidates[i, j]))
+        ret[i] = [scenario.get(o) for o in outputs]
+    return ret
+
+
+def goal_seek(sheet: Sheet[Tick],
+              targets: Sequence[CellValue], goal: float,
+              inputs: Sequence[CellValue], lo: float, hi: float,
+              reduce: Callable[..., Any] = np.min,
+              batch: int = 16, tol: float = 1e-6, max_passes: int = 50) -> float:
+    """
+    inputsのすべてのセルに同じ値xを入れたとき、targetsの値をreduceでまとめたものが
+    goalになるxを、[lo, hi]の中で探す。まとめた値はxについて単調であること
+
+    1回の計算でbatch個の候補を調べ、区間を(batch + 1)分の1に狭めていく
+    結果は、まとめた値がgoal以上になる側の端を返すので、
+    「期末在庫が毎日50以上」のような条件を満たす値になる
+    """
+    def f(xs: np.ndarray) -> np.ndarray:
+        values = probe(sheet, inputs, np.repeat(xs[:, None], len(inputs), axis=1), targets)
+        return reduce(values, axis=1) - goal
+
+    ends = f(np.array([lo, hi], dtype=np.float64))
+    if ends[0] == 0:
+        return lo
+    if ends[1] == 0:
+        return hi
+    if np.sign(ends[0]) == np.sign(ends[1]):
+        raise NoSolution(f"goal {goal} is not between f({lo}) and f({hi})")
+    increasing = ends[1] > 0
+
+    for _ in range(max_passes):
+        if hi - lo <= tol:
+            break
+        xs = np.linspace(lo, hi, batch + 2)[1:-1]
+        ys = f(xs)
+        above = ys >= 0 if increasing else ys <= 0
+        # 条件を満たす最初の候補と、その1つ手前の候補で区間を挟み直す
+        i = int(np.argmax(above)) if above.any() else len(xs)
+        if i < len(xs):
+            hi = xs[i]
+        if i > 0:
+            lo = xs[i - 1]
+    return hi if increasing else lo
+
+
+def optimize(sheet: Sheet[Tick],
+             targets: Sequence[CellValue],
+             inputs: Sequence[CellValue],
+             bounds: Sequence[Tuple[float, float]],
+             reduce: Callable[..., Any] = np.sum, maximize: bool = False,
+             batch: int = 16, passes: int = 10, shrink: float = 0.5
+             ) -> Tuple[np.ndarray, float]:
+    """
+    targetsの値をreduceでまとめたものを最小(maximize=Trueなら最大)にする入力の値を、
+    boundsの範囲で探す。入力ごとに範囲をbatch個に区切って1回で計算し、
+    最も良い値の周りに範囲をshrink倍に狭めることをpasses回くり返す
+    最良の入力の値と、そのときのまとめた値を返す
+    """
+    lows = np.array([b[0] for b in bounds], dtype=np.float64)
+    highs = np.array([b[1] for b in bounds], dtype=np.float64)
+    best = (lows + highs) / 2
+    sign = -1.0 if maximize else 1.0
+
+    def score(candidates: np.ndarray) -> np.ndarray:
+        return sign * reduce(probe(sheet, inputs, candidates, targets), axis=1)
+
+    best_score = float(score(best[None, :])[0])
+    width = highs - lows
+    for _ in range(passes):
+        for j in range(len(inputs)):
+            a = max(lows[j], best[j] - width[j] / 2)
+            b = min(highs[j], best[j] + width[j] / 2)
+            candidates = np.repeat(best[None, :], batch, axis=0)
+            candidates[:, j] = np.linspace(a, b, batch)
+            scores = score(candidates)
+            i = int(np.argmin(scores))
+            if scores[i] < best_score:
+                best, best_score = candidates[i], float(scores[i])
+        width = width * shrink
+    return best, sign * best_score
+
+
+def jacobian(sheet: Sheet[Tick], outputs: Sequence[CellValue],
+             inputs: Sequence[CellValue]) -> np.ndarray:
+    """
+    outputsのセルの、inputsのセルについての微分を(出力の数 x 入力の数)の配列で返す
+
+    入力のセルの値をDual(値, 単位ベクトル)に差し替え、入力の子孫を1回だけ計算する
+    途中にdifferentiable=Trueでないタスクがあると、その先の微分はNaNになる
+    """
+    n = len(inputs)
+    scenario = Scenario(sheet)
+    for j, node in enumerate(inputs):
+        scenario.set(node, Dual(node.value, np.eye(n)[j]))
+    ret = np.zeros((len(outputs), n), dtype=np.float64)
+    for i, o in enumerate(outputs):
+        v = scenario.get(o)
+        if isinstance(v, Dual):
+            ret[i] = v.grad
+    return ret
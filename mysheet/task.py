@@ -1,11 +1,19 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
+from typing import Mapping, Optional
 
 
 class Task(ABC):
+    # 子がなくなったとき、DependencyGraph.collectで取り除いてよいか
+    collectable = True
+    # DependencyGraph.cacheがあるとき、結果をディスクに保存して再利用するか
+    persistent = False
+
     def __init__(self) -> None:
         self.done: bool = False
         self._name = f"[{id(self)}]"
+        # Trueのタスクは、calculate_asyncでイベントループ上で並行に実行される
+        self.is_async: bool = False
 
     @property
     def name(self) -> str:
@@ -15,15 +23,46 @@ class Task(ABC):
     def name(self, s: str) -> None:
         self._name = s
 
+    @property
+    def label(self) -> Optional[str]:
+        """
+        エラーメッセージなどで利用者に見せる名前。セルに対応しないタスクはNone
+        """
+        return None
+
+    def fingerprint(self, known: Mapping[Task, Optional[str]]) -> Optional[str]:
+        """
+        計算の中身と、推移的な入力の値から決まる指紋。knownには親の指紋が入っている
+        指紋が同じなら結果も同じになる。作れない場合や、純粋でない場合はNone
+        """
+        return None
+
     def run(self) -> None:
         if self.done:
             return
         self.execute()
         self.done = True
 
+    async def run_async(self) -> None:
+        if self.done:
+            return
+        await self.execute_async()
+        self.done = True
+
     def reset(self) -> None:
         self.done = False
 
+    def refresh(self) -> bool:
+        """
+        計算し直し、結果が変わった可能性があればTrueを返す
+        """
+        self.reset()
+        self.run()
+        return True
+
     @abstractmethod
     def execute(self) -> None:
         pass
+
+    async def execute_async(self) -> None:
+        self.execute()
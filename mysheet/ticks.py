@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 from datetime import date as _date, timedelta
-from typing import Generic, List, Pattern, Sequence, TypeVar, Union, overload
+from typing import TYPE_CHECKING, Generic, List, Pattern, Sequence, TypeVar, Union, overload
 from dataclasses import dataclass
 import re
 
-from mdweek import Week as MDWeek
+if TYPE_CHECKING:
+    from mdweek import Week as MDWeek
 
 from mysheet.exceptions import InvalidFormat, UnterminatingSlice
 
@@ -99,6 +100,8 @@ class Week(SliceMixIn):
     pattern = re.compile(r"([0-9]{4})-W([0-9]{2})")
 
     def to_mdweek(self) -> MDWeek:
+        # mdweekは週を使うときだけ読み込む
+        from mdweek import Week as MDWeek
         return MDWeek(self.year, self.week)
 
     @staticmethod
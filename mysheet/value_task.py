@@ -1,16 +1,84 @@
 from __future__ import annotations
 
-from typing import Callable, Generator, Generic, Optional, Sequence, TypeVar, Union
+from contextlib import contextmanager
+import inspect
+import math
+import operator
+from typing import Any, Callable, Dict, Generator, Generic, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, TypeVar, Union, cast, overload
 
 
-from .exceptions import AccessEmptyCell, NotEvaluated
+from .dual import Dual, primal
+from .exceptions import AccessEmptyCell, CyclicDependency, NotEvaluated
+from .memo import LRUCache, digest, digest_function, digest_value, memoize
+from .row_formula import RowFormula
 from .task import Task
 from . import dependency_graph
 
 V = TypeVar("V")
 
 
+# シナリオ(Scenario)の計算中だけ使う、ValueTaskの値の差し替え
+_overlay: Optional[Dict[Task, Any]] = None
+
+
+@contextmanager
+def overlay(values: Dict[Task, Any]) -> Iterator[None]:
+    """
+    ブロックの中では、valuesにあるタスクの値としてvaluesの値を返す
+    スレッドごとではなくプロセス全体で切り替わるので、並行には使わないこと
+    """
+    global _overlay
+    saved = _overlay
+    _overlay = values
+    try:
+        yield
+    finally:
+        _overlay = saved
+
+
+def same_value(a: Any, b: Any) -> bool:
+    if isinstance(a, Dual) or isinstance(b, Dual):
+        # 値が同じでも微分を持っているので、別の値として扱う
+        return False
+    try:
+        return bool(a == b)
+    except Exception:
+        # 配列などで比較結果が真偽値にならない場合は、変わったものとみなす
+        return False
+
+
+@overload
 def task(f: Callable[..., V]) -> Callable[..., ValueTask[V]]:
+    ...
+
+
+@overload
+def task(*, pure: bool = False,
+         cache: Union[None, int, LRUCache] = None,
+         differentiable: bool = False
+         ) -> Callable[[Callable[..., V]], Callable[..., ValueTask[V]]]:
+    ...
+
+
+def task(f=None, *, pure=False, cache=None, differentiable=False):
+    """
+    関数を、ValueTaskを返す関数に変換するデコレータ
+
+    pure=Trueは、同じ引数の値に対して常に同じ結果を返す関数であることを表す
+    pure=Trueの関数にcacheを指定すると、引数の値をキーに結果を再利用する
+    cacheには、LRUCacheか、その最大件数を指定する
+    differentiable=Trueは、引数にDualを渡しても正しく計算できる関数であることを表す
+    """
+    if f is None:
+        return lambda f: task(f, pure=pure, cache=cache, differentiable=differentiable)
+
+    memo: Optional[LRUCache] = None
+    if cache is not None:
+        if not pure:
+            raise ValueError(f"{f.__name__}: cache requires pure=True")
+        memo = cache if isinstance(cache, LRUCache) else LRUCache(cache)
+        f = memoize(f, memo)
+
     count_of_this_task = 0
 
     def make_value(*args, **kwargs):
@@ -23,26 +91,17 @@ def task(f: Callable[..., V]) -> Callable[..., ValueTask[V]]:
             for s, v in kwargs.items()
         }
 
-        def executor():
-            args = [v.value for v in args2]
-            kwargs = {
-                s: v.value
-                for s, v in kwargs2.items()
-            }
-            return f(*args, **kwargs)
-
-        value = ValueTask(executor)
-        g = dependency_graph.get()
-        for v in args2:
-            g.add_dependency(v, value)
-        for _, v in kwargs2.items():
-            g.add_dependency(v, value)
+        value = FunctionTask(f, args2, kwargs2)
+        value.pure = pure
+        value.differentiable = differentiable
 
         nonlocal count_of_this_task
         value.name += f"\n({f.__name__}-{count_of_this_task})"
         count_of_this_task += 1
 
         return value
+
+    make_value.cache = memo  # type: ignore
     return make_value
 
 
@@ -51,45 +110,151 @@ class ValueTask(Task, Generic[V]):
         super().__init__()
         self._value: Optional[V] = None
         self.calculate = f
+        self.is_async = inspect.iscoroutinefunction(f)
+        # 同じ入力に対して常に同じ値になるかどうか
+        self.pure = False
+        # 引数がDualのとき、微分も正しく計算できるかどうか
+        self.differentiable = False
 
     def execute(self) -> None:
-        self._value = self.calculate()
+        self._value = self.compute()
+
+    def compute(self) -> V:
+        """
+        親の値から自分の値を計算して返す。自分の状態は変えない
+        """
+        if self.is_async:
+            # 同期的な計算では、非同期タスクも1つずつ完了を待つ
+            import asyncio
+            return asyncio.run(self.calculate())  # type: ignore
+        return self.calculate()
+
+    async def execute_async(self) -> None:
+        if self.is_async:
+            self._value = await self.calculate()  # type: ignore
+        else:
+            self.execute()
 
     def __str__(self) -> str:
         return str(self._value)
 
     @property
     def value(self) -> V:
+        if _overlay is not None and self in _overlay:
+            return _overlay[self]
         if not self.done:
-            raise NotEvaluated()
+            g = dependency_graph.get()
+            if not g.lazy:
+                raise NotEvaluated()
+            g.evaluate(self)
         return self._value  # type: ignore
 
+    def peek(self, default: V) -> V:
+        """
+        計算済みならその値を、そうでなければdefaultを返す。遅延評価はしない
+        """
+        if not self.done or self._value is None:
+            return default
+        return self._value
+
+    def restore(self, v: V) -> None:
+        """
+        保存しておいた計算結果を、計算済みの値として設定する
+        """
+        self._value = v
+        self.done = True
+
     def reset(self) -> None:
         super().reset()
         self._value = None
 
-    @task
-    def __add__(self, v: Union[V, ValueTask[V]]):
-        return self + v
-
-    @task
-    def __sub__(self, v: Union[V, ValueTask[V]]):
-        return self - v
+    def refresh(self) -> bool:
+        done, old = self.done, self._value
+        self.reset()
+        self.run()
+        return not done or not same_value(old, self._value)
+
+    __add__ = task(pure=True, differentiable=True)(operator.add)
+    __sub__ = task(pure=True, differentiable=True)(operator.sub)
+    __mul__ = task(pure=True, differentiable=True)(operator.mul)
+    __truediv__ = task(pure=True, differentiable=True)(operator.truediv)
+
+
+class FunctionTask(ValueTask[V]):
+    """
+    @taskを付けた関数の呼び出し。引数のタスクの値を渡してfuncを実行する
+    """
+
+    def __init__(self, func: Callable[..., V],
+                 args: Sequence[ValueTask], kwargs: Dict[str, ValueTask]) -> None:
+        self.func = func
+        self.args = list(args)
+        self.kwargs = dict(kwargs)
+        if inspect.iscoroutinefunction(func):
+            # コルーチンを返す関数は、execute_asyncで待って値を得る
+            super().__init__(cast(Callable[[], V], self._call_async))
+        else:
+            super().__init__(self._call)
 
-    @task
-    def __mul__(self, v: Union[V, ValueTask[V]]):
-        return self * v
+        g = dependency_graph.get()
+        for v in self.args:
+            g.add_dependency(v, self)
+        for v in self.kwargs.values():
+            g.add_dependency(v, self)
 
-    @task
-    def __truediv__(self, v: Union[V, ValueTask[V]]):
-        return self / v
+    def _call(self) -> V:
+        args = [v.value for v in self.args]
+        kwargs = {
+            s: v.value
+            for s, v in self.kwargs.items()
+        }
+        if not self.differentiable and (
+                any(isinstance(a, Dual) for a in args) or
+                any(isinstance(a, Dual) for a in kwargs.values())):
+            return self._call_primal(args, kwargs)
+        return self.func(*args, **kwargs)
+
+    def _call_primal(self, args: List[Any], kwargs: Dict[str, Any]) -> V:
+        """
+        微分に対応していない関数には値だけを渡す
+        結果の微分は分からないので、NaNにする
+        """
+        grad = next(
+            a.grad for a in [*args, *kwargs.values()] if isinstance(a, Dual))
+        ret = self.func(
+            *[primal(a) for a in args],
+            **{s: primal(a) for s, a in kwargs.items()})
+        return Dual(ret, grad * math.nan)  # type: ignore
+
+    def fingerprint(self, known: Mapping[Task, Optional[str]]) -> Optional[str]:
+        if not self.pure:
+            return None
+        parents = [known.get(v) for v in self.args]
+        parents += [f"{s}={known.get(v)}" if known.get(v) else None
+                    for s, v in sorted(self.kwargs.items())]
+        f = digest_function(self.func)
+        if f is None or None in parents:
+            return None
+        return digest(b"call", f, *parents)
+
+    async def _call_async(self) -> V:
+        args = [v.value for v in self.args]
+        kwargs = {
+            s: v.value
+            for s, v in self.kwargs.items()
+        }
+        return await self.func(*args, **kwargs)  # type: ignore
 
 
 class Constant(ValueTask[V]):
     def __init__(self, v: V) -> None:
         super().__init__(lambda: v)
+        self.pure = True
         self.run()
 
+    def fingerprint(self, known: Mapping[Task, Optional[str]]) -> Optional[str]:
+        return digest_value(self._value)
+
     def reset(self) -> None:
         super().reset()
         self.run()
@@ -105,16 +270,30 @@ class ValueArray(ValueTask[Sequence[V]]):
             return [v.value for v in vs]
 
         super().__init__(calculate)
+        self.pure = True
         self.vs = vs
 
         def __iter__(self) -> Generator[ValueTask[V], None, None]:
             return self.vs
 
+    def fingerprint(self, known: Mapping[Task, Optional[str]]) -> Optional[str]:
+        parents = [known.get(v) for v in self.vs]
+        if None in parents:
+            return None
+        return digest(b"array", *parents)
+
+
+# セルの式、行の式、行の式が参照するセル
+CellState = Tuple[Optional[ValueTask[float]], Optional[RowFormula], Tuple["CellValue", ...]]
+
 
 class Cell:
     def __init__(self, row: str, col: str):
         self.value = CellValue(self)
         self._formula: Optional[ValueTask[float]] = None
+        # 行の式(RowFormula)と、その式が参照するこの列のセル
+        self._row_formula: Optional[RowFormula] = None
+        self._sources: Sequence[CellValue] = ()
         self.row = row
         self.col = col
 
@@ -131,15 +310,79 @@ class Cell:
     @formula.setter
     def formula(self, v: Union[float, ValueTask[float]]) -> None:
         new_v = v if isinstance(v, ValueTask) else Constant(v)
-        g = dependency_graph.get()
-        try:
-            old_v = self.formula
-            g.remove_dependency(old_v, self.value)
-        except AccessEmptyCell:
-            pass
-        g.add_dependency(new_v, self.value)
+        if new_v is self._formula:
+            return
+        self._replace_parents([new_v])
+        dependency_graph.get().lineage.set_parents(self.value, source_cells(new_v))
 
         self._formula = new_v
+        self._row_formula = None
+        self._sources = ()
+
+    @property
+    def row_formula(self) -> Optional[RowFormula]:
+        return self._row_formula
+
+    def set_row_formula(self, f: RowFormula, sources: Sequence[CellValue]) -> None:
+        """
+        行の式を、この列のセルsourcesに当てはめて使う
+        式のノードは作らず、sourcesからこのセルへ直接辺を張る
+        """
+        self._replace_parents(sources)
+        dependency_graph.get().lineage.set_parents(self.value, sources)
+
+        self._formula = None
+        self._row_formula = f
+        self._sources = tuple(sources)
+
+    def save(self) -> CellState:
+        """
+        restoreで元に戻すために、今の式を取っておく
+        """
+        return self._formula, self._row_formula, tuple(self._sources)
+
+    def restore(self, state: CellState) -> None:
+        """
+        saveで取っておいた式に戻す。空だったセルは空に戻す
+        """
+        formula, row_formula, sources = state
+        if formula is not None:
+            self.formula = formula
+        elif row_formula is not None:
+            self.set_row_formula(row_formula, sources)
+        else:
+            self._replace_parents([])
+            dependency_graph.get().lineage.set_parents(self.value, [])
+            self._formula = None
+            self._row_formula = None
+            self._sources = ()
+
+    def _replace_parents(self, parents: Sequence[ValueTask]) -> None:
+        g = dependency_graph.get()
+        old = [self._formula] if self._formula is not None else list(self._sources)
+        added: List[ValueTask] = []
+        try:
+            for p in parents:
+                if p not in old and p not in added:
+                    g.add_dependency(p, self.value)
+                    added.append(p)
+        except CyclicDependency:
+            # 循環する場合は、追加した辺を戻して元の式のままにする
+            for p in added:
+                g.remove_dependency(p, self.value)
+            # 登録できなかった式のノードは、どこからも使われないので回収する
+            for p in parents:
+                if p not in old:
+                    g.discard(p)
+            raise
+        for p in old:
+            if p not in parents:
+                g.remove_dependency(p, self.value)
+
+    def evaluate(self) -> float:
+        if self._row_formula is not None:
+            return self._row_formula.func(*[s.value for s in self._sources])
+        return self.formula.value
 
     @property
     def result(self) -> float:
@@ -147,10 +390,53 @@ class Cell:
 
     @property
     def empty(self) -> bool:
-        return self._formula is None
+        return self._formula is None and self._row_formula is None
+
+
+def source_cells(formula: ValueTask) -> List[CellValue]:
+    """
+    式が直接参照しているセルを、間の演算ノードをたどって集める
+    """
+    g = dependency_graph.get()
+    ret: List[CellValue] = []
+    visited: Set[Task] = set()
+    stack: List[Task] = [formula]
+    while len(stack) > 0:
+        current = stack.pop()
+        if current in visited:
+            continue
+        visited.add(current)
+        if isinstance(current, CellValue):
+            ret.append(current)
+        else:
+            stack.extend(g.get_parents(current))
+    return ret
 
 
 class CellValue(ValueTask[float]):
+    collectable = False
+
     def __init__(self, cell: Cell) -> None:
         self.cell = cell
-        super().__init__(lambda: self.cell.formula.value)
+        super().__init__(lambda: self.cell.evaluate())
+        self.pure = True
+
+    @property
+    def label(self) -> Optional[str]:
+        return self.cell.name
+
+    @property
+    def persistent(self) -> bool:  # type: ignore
+        # 入力のセルは、保存しなくてもすぐに値が分かる
+        return not isinstance(self.cell._formula, Constant)
+
+    def fingerprint(self, known: Mapping[Task, Optional[str]]) -> Optional[str]:
+        cell = self.cell
+        if cell.row_formula is not None:
+            parents = [known.get(s) for s in cell._sources]
+            if None in parents:
+                return None
+            return digest(b"row", cell.row_formula.source, *parents)
+        if cell.empty:
+            return None
+        return known.get(cell.formula)
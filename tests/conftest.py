@@ -1,8 +1,46 @@
+from typing import Callable, Optional
+
 import pytest
 
 from mysheet import dependency_graph
+from mysheet.sheet import Sheet
+from mysheet.ticks import Date
+from mysheet.value_task import ValueTask
 
 
 @pytest.fixture
 def clear_graph():
     dependency_graph.clear()
+
+
+@pytest.fixture
+def lazy_graph(clear_graph):
+    g = dependency_graph.get()
+    g.lazy = True
+    yield g
+    g.lazy = False
+
+
+@pytest.fixture
+def inventory(clear_graph) -> Callable[..., Sheet]:
+    """
+    startから5日分の在庫表(期初在庫、入荷、出荷、期末在庫)を計算して返す関数
+    出荷は毎日out_stepずつ増やせる。clipを渡すと、期末在庫の式をclipに通す
+    """
+    def build(start: Date, out_step: int = 0,
+              clip: Optional[Callable[[ValueTask], ValueTask]] = None) -> Sheet:
+        end = start + 4
+        sheet = Sheet(start, end, ["start", "in", "out", "end"])
+        sheet["start", start] = 100
+        today = start
+        while today <= end:
+            sheet["in", today] = 10
+            sheet["out", today] = 20 + (today - start) * out_step
+            if today > start:
+                sheet["start", today] = sheet["end", today - 1]
+            v = sheet["start", today] + sheet["in", today] - sheet["out", today]
+            sheet["end", today] = v if clip is None else clip(v)
+            today += 1
+        sheet.calculate()
+        return sheet
+    return build
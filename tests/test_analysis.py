@@ -0,0 +1,46 @@
+from mysheet import analysis, dependency_graph
+from mysheet.row_formula import Ref
+from mysheet.sheet import Sheet
+from mysheet.ticks import Date
+from mysheet.value_task import Constant
+
+
+def test_csr(clear_graph):
+    a = Constant(1)
+    b = Constant(2)
+    c = a + b
+    d = c * 2
+    csr = analysis.to_csr()
+    index = {n: i for i, n in enumerate(csr.nodes)}
+    assert sorted(csr.children(index[a]).tolist()) == [index[c]]
+    assert sorted(csr.children(index[c]).tolist()) == [index[d]]
+    assert analysis.levels(csr)[index[d]] == 2
+
+
+def test_analyze(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 3, ["start", "in", "end"])
+    sheet["start", start] = 0
+    sheet.set_row_formula("start", Ref("end", -1), start=start + 1)
+    sheet.set_row_formula("end", Ref("start") + Ref("in"))
+    for i in range(4):
+        sheet["in", start + i] = i
+
+    report = analysis.analyze(sheet=sheet)
+    # 12個のセルと、定数5つ
+    assert report.num_nodes == 17
+    assert report.num_cells == 12
+    # 定数 -> 期初 -> 期末 -> 期初 -> ... -> 期末
+    assert report.depth == 9
+    assert report.critical_path[-1] is sheet["end", start + 3]
+    assert report.critical_path_time == 9
+    assert report.level_widths.sum() == 17
+
+    dependency_graph.get().calculate(profile=True)
+    report = analysis.analyze(sheet=sheet)
+    assert report.timed
+    assert report.max_speedup >= 1
+
+    table = analysis.node_table(sheet, analysis.to_csr())
+    assert len(table) == 12
+    assert set(table["row"].tolist()) == {0, 1, 2}
@@ -1,6 +1,11 @@
-from mysheet.value_task import Constant, ValueTask, task
+import asyncio
+
+from mysheet.value_task import Constant, ValueArray, ValueTask, task
 from mysheet import dependency_graph
-from mysheet.exceptions import CyclicDependency
+from mysheet.exceptions import CalculationFailed, CyclicDependency
+from mysheet.observer import NullObserver, Observer
+from mysheet.sheet import Sheet
+from mysheet.ticks import Date
 
 
 def test_parent(clear_graph):
@@ -59,13 +64,29 @@ def test_cycle(clear_graph):
     g = dependency_graph.get()
     g.add_dependency(a, b)
     g.add_dependency(b, c)
-    g.add_dependency(c, a)
 
     try:
-        next(g.get_calculation_tasks())
+        g.add_dependency(c, a)
         assert False
-    except CyclicDependency:
-        return
+    except CyclicDependency as e:
+        assert e.path == [c.name, a.name, b.name, c.name]
+
+    # 循環を作る辺は追加されない
+    assert list(g.get_calculation_tasks()) == [a, b, c]
+
+
+def test_reorder(clear_graph):
+    a = Constant(1)
+    b = Constant(1)
+    c = Constant(1)
+    d = Constant(1)
+    g = dependency_graph.get()
+    g.add_dependency(c, d)
+    g.add_dependency(a, b)
+    g.add_dependency(b, c)
+
+    tasks = list(g.get_calculation_tasks())
+    assert tasks.index(a) < tasks.index(b) < tasks.index(c) < tasks.index(d)
 
 
 def test_update(clear_graph):
@@ -85,3 +106,247 @@ def test_update(clear_graph):
     assert len(ret) == 2
     assert set(ret) == set([a, c])
     assert c.value == 5
+
+
+def test_lazy_evaluate(lazy_graph):
+    calls = []
+
+    @task
+    def record(name, x):
+        calls.append(name)
+        return x + 1
+
+    a = record("a", Constant(1))
+    b = record("b", a)
+    c = record("c", Constant(10))
+
+    assert b.value == 3
+    assert calls == ["a", "b"]
+    assert not c.done
+
+    # 計算済みの結果は再利用される
+    assert b.value == 3
+    assert calls == ["a", "b"]
+
+
+def test_calculate_async(clear_graph):
+    running = 0
+    peak = 0
+
+    @task
+    async def fetch(x):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return x * 2
+
+    one = Constant(1)
+    values = [fetch(one + i) for i in range(8)]
+    total = ValueArray(values)
+
+    g = dependency_graph.get()
+    asyncio.run(g.calculate_async(concurrency=4))
+
+    assert total.value == [2 * (i + 1) for i in range(8)]
+    assert peak == 4
+
+
+def test_async_task_in_sync_calculate(clear_graph):
+    @task
+    async def double(x):
+        await asyncio.sleep(0)
+        return x * 2
+
+    four = double(Constant(2))
+    dependency_graph.get().calculate()
+    assert four.value == 4
+
+
+def test_collect(clear_graph):
+    g = dependency_graph.get()
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start, ["a", "b"])
+    sheet["a", start] = 1
+    sheet["b", start] = (sheet["a", start] + 1) * 2 - 3
+    n = len(g.graph)
+
+    sheet["b", start] = sheet["a", start]
+    # 古い式は、回収するまで計算グラフに残る
+    assert len(g.graph) == n
+    # 3つの演算ノードと、リテラルの1, 2, 3
+    assert g.collect() == 6
+    assert set(g.graph.nodes) == set([
+        sheet["a", start], sheet["b", start],
+        sheet["a", start].cell.formula])
+
+
+def test_auto_collect(clear_graph):
+    g = dependency_graph.get()
+    g.auto_collect = True
+    try:
+        start = Date(2000, 1, 1)
+        sheet = Sheet(start, start, ["a", "b", "c"])
+        sheet["a", start] = 1
+        shared = sheet["a", start] + 1
+        sheet["b", start] = shared * 2
+        sheet["c", start] = shared * 3
+
+        # sharedは、cの式からまだ使われている
+        sheet["b", start] = 5
+        assert shared in g.graph
+        g.calculate()
+        assert sheet["c", start].value == 6
+
+        sheet["c", start] = 7
+        assert shared not in g.graph
+    finally:
+        g.auto_collect = False
+
+
+def test_reuse_held_expression(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start, ["a", "b", "c", "d"])
+    sheet["a", start] = 1
+    sheet["b", start] = 2
+    tmp = sheet["a", start] + sheet["b", start]
+    sheet["c", start] = tmp * 10
+    sheet["c", start] = 5
+    # 既定では回収しないので、持っている部分式を別のセルで使い直せる
+    sheet["d", start] = tmp
+    sheet.calculate()
+    assert sheet["d", start].value == 3
+    sheet.update("b", start, 101)
+    assert sheet["d", start].value == 102
+
+
+def test_resume(clear_graph):
+    calls = []
+
+    @task
+    def check(x):
+        calls.append(x)
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+    a = Constant(-1)
+    b = check(a)
+    c = b + 1
+    d = check(Constant(2)) * 2
+
+    g = dependency_graph.get()
+    try:
+        g.calculate()
+        assert False
+    except CalculationFailed as e:
+        assert list(e.errors) == [b]
+        assert isinstance(e.__cause__, ValueError)
+    assert g.poisoned == {c}
+    assert not b.done and not c.done
+    # 失敗に関係のない部分は計算できている
+    assert d.value == 4
+
+    a.calculate = lambda: 1
+    a.reset()
+    calls.clear()
+    g.calculate()
+    assert calls == [1]
+    assert c.value == 2
+    assert len(g.errors) == 0 and len(g.poisoned) == 0
+
+
+class Recorder(Observer):
+    every = 2
+
+    def __init__(self) -> None:
+        self.events = []
+
+    def on_start(self, total):
+        self.events.append(("start", total))
+
+    def on_task_done(self, task, count):
+        self.events.append(("done", count))
+
+    def on_finish(self, count, failed):
+        self.events.append(("finish", count, failed))
+
+
+def test_observer(clear_graph):
+    a = Constant(1)
+    b = Constant(2)
+    (a + b) * (a - b)
+
+    g = dependency_graph.get()
+    recorder = Recorder()
+    g.observer = recorder
+    try:
+        g.calculate()
+    finally:
+        g.observer = NullObserver()
+    # 2つ終わるごとにだけ呼ばれる
+    assert recorder.events == [
+        ("start", 5), ("done", 2), ("done", 4), ("finish", 5, 0)]
+
+
+def test_observer_finish_on_failure(clear_graph):
+    @task
+    async def fail(x):
+        raise ValueError(x)
+
+    fail(Constant(1)) + 1
+
+    g = dependency_graph.get()
+    recorder = Recorder()
+    g.observer = recorder
+    try:
+        asyncio.run(g.calculate_async())
+        assert False
+    except ValueError:
+        pass
+    finally:
+        g.observer = NullObserver()
+    # 途中で失敗しても、進捗の表示は閉じる
+    assert recorder.events[0] == ("start", 4)
+    assert recorder.events[-1] == ("finish", 2, 0)
+
+
+def test_components(clear_graph):
+    a = Constant(1)
+    b = a + 1
+    c = Constant(2)
+    d = c * 3
+    e = b + d
+
+    g = dependency_graph.get()
+    assert len(g.components()) == 1
+    g.remove_task(e)
+    components = g.components()
+    assert sorted(len(x) for x in components) == [3, 3]
+    assert any(a in x and b in x and c not in x for x in components)
+
+
+def test_calculate_parallel(clear_graph):
+    start = Date(2000, 1, 1)
+    end = start + 9
+    sheets = []
+    for i in range(4):
+        sheet = Sheet(start, end, ["stock"])
+        sheet["stock", start] = i
+        for k in range(1, 10):
+            sheet["stock", start + k] = sheet["stock", start + k - 1] + 1
+        sheets.append(sheet)
+    broken = Sheet(start, end, ["stock"])
+    broken["stock", end] = broken["stock", start] + 1
+
+    g = dependency_graph.get()
+    assert len(g.components()) == 5
+    try:
+        g.calculate_parallel(processes=2)
+        assert False
+    except CalculationFailed as e:
+        assert list(e.errors) == [broken["stock", start]]
+    assert broken["stock", end] in g.poisoned
+    for i, sheet in enumerate(sheets):
+        assert sheet["stock", end].value == i + 9
@@ -0,0 +1,69 @@
+from mysheet import dependency_graph
+from mysheet.fusion import fuse
+from mysheet.sheet import Sheet
+from mysheet.ticks import Date
+from mysheet.value_task import Constant, ValueArray, ValueTask
+
+
+def test_fuse_chain(clear_graph):
+    a = Constant(1.0)
+    b = ValueTask(lambda: 2.0)
+    c = ValueTask(lambda: 3.0)
+    d = (a + b) * c - a / 2
+    g = dependency_graph.get()
+    n = len(g.graph)
+
+    # 途中の3つの演算ノードと、リテラルの2
+    assert fuse() == 4
+    assert len(g.graph) == n - 4
+    assert set(g.get_parents(d)) == set([a, b, c])
+
+    g.calculate()
+    assert d.value == 8.5
+
+
+def test_fuse_keeps_shared_nodes(clear_graph):
+    one = Constant(1)
+    two = one + one
+    three = two + one
+    array = ValueArray([two, three])
+
+    # twoは2つの子から参照されているので、まとめない
+    assert fuse() == 0
+    dependency_graph.get().calculate()
+    assert array.value == [2, 3]
+
+
+def test_fuse_sheet(clear_graph):
+    start = Date(2022, 5, 30)
+    end = start + 4
+    sheet = Sheet(start, end, ["start", "in", "out", "end"])
+    sheet["start", start] = 100
+    today = start
+    while today <= end:
+        sheet["in", today] = 10
+        sheet["out", today] = 20
+        if today > start:
+            sheet["start", today] = sheet["end", today - 1]
+        sheet["end", today] = (
+            sheet["start", today] +
+            sheet["in", today] -
+            sheet["out", today]
+        )
+        today += 1
+
+    assert sheet.fuse() == 5
+    sheet.calculate()
+    assert sheet.get_row_values("end").tolist() == [90, 80, 70, 60, 50]
+
+    ret = sheet.update("in", start + 2, 30)
+    assert len(ret) == 6
+    assert sheet["end", end].value == 70
+
+
+def test_fuse_repeated_constant(clear_graph):
+    a = Constant(2)
+    d = (a + a) * ValueTask(lambda: 3.0)
+    assert fuse() == 2
+    dependency_graph.get().calculate()
+    assert d.value == 12
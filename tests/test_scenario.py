@@ -0,0 +1,53 @@
+from mysheet.sheet import Sheet
+from mysheet.ticks import Date
+from mysheet.value_task import task
+
+
+START = Date(2022, 5, 30)
+END = START + 4
+
+
+def test_fork(inventory):
+    sheet = inventory(START)
+    a = sheet.fork()
+    b = sheet.fork()
+    a["in", START + 2] = 50
+    b["out", START + 4] = 0
+
+    assert a["end", END] == 90
+    assert b["end", END] == 70
+    # 元のシートは変わらない
+    assert sheet["end", END].value == 50
+
+    assert a.diff() == {
+        ("in", "2022-06-01"): (10, 50),
+        ("end", "2022-06-01"): (70, 110),
+        ("start", "2022-06-02"): (70, 110),
+        ("end", "2022-06-02"): (60, 100),
+        ("start", "2022-06-03"): (60, 100),
+        ("end", "2022-06-03"): (50, 90),
+    }
+    assert b.diff(a)[("end", "2022-06-03")] == (90, 70)
+    assert a.get_values()[3].tolist() == [90, 80, 110, 100, 90]
+
+
+def test_fork_cutoff(clear_graph):
+    calls = []
+
+    @task
+    def clamp(x):
+        calls.append(x)
+        return max(x, 0)
+
+    sheet = Sheet(START, START, ["a", "b", "c"])
+    sheet["a", START] = -1
+    sheet["b", START] = clamp(sheet["a", START])
+    sheet["c", START] = sheet["b", START] + 1
+    sheet.calculate()
+
+    fork = sheet.fork()
+    fork["a", START] = -5
+    assert fork["c", START] == 1
+    assert calls == [-1, -5]
+    # 値が変わらなかったタスクは持たない
+    assert fork.diff() == {("a", "2022-05-30"): (-1, -5)}
@@ -0,0 +1,116 @@
+import http.client
+import json
+import socket
+import threading
+
+from mysheet.server import SheetServer, make_http_server, make_unix_server
+from mysheet.sheet import Sheet
+from mysheet.ticks import Date
+
+
+START = Date(2022, 5, 30)
+END = START + 4
+
+
+def test_handle(inventory):
+    server = SheetServer({"a": inventory(START)})
+    ret = server.handle({
+        "updates": [
+            {"sheet": "a", "row": "in", "col": str(START), "value": 20},
+            {"sheet": "a", "row": "out", "col": str(START + 1), "value": 10},
+        ],
+        "reads": [{"sheet": "a", "row": "end", "col": str(END)}],
+    })
+    assert ret["values"] == [70]
+    changed = {(c["row"], c["col"]): c["value"] for c in ret["changed"]}
+    assert changed[("end", str(START))] == 100
+    assert changed[("end", str(END))] == 70
+
+    ret = server.handle({"reads": [{"sheet": "a", "row": "end"}], "metrics": True})
+    assert ret["values"] == [[100, 100, 90, 80, 70]]
+    assert ret["metrics"]["update"]["count"] == 1
+    assert ret["metrics"]["read"]["count"] == 1
+
+    ret = server.handle({"reads": [{"sheet": "b"}]})
+    assert "error" in ret
+
+
+def test_invalid_request(inventory):
+    server = SheetServer({"a": inventory(START)})
+    for request in [[1], "x", None]:
+        ret = server.handle(request)
+        assert ret["error"].startswith("InvalidData")
+
+
+def test_read_empty_cell(clear_graph):
+    sheet = Sheet(START, END, ["a", "b"])
+    sheet["a", START] = 1
+    sheet.calculate()
+    server = SheetServer({"s": sheet})
+    ret = server.handle({"reads": [
+        {"sheet": "s", "row": "a", "col": str(START)},
+        {"sheet": "s", "row": "b", "col": str(START)},
+    ]})
+    assert ret["values"] == [1, None]
+    # 読み込みではセルを作らない
+    assert [len(row) for row in sheet.cells] == [1, 0]
+
+
+def test_partly_invalid_batch(inventory):
+    sheet = inventory(START)
+    server = SheetServer({"a": sheet})
+    for bad in [
+        {"sheet": "a", "row": "nope", "col": str(START), "value": 1},
+        {"sheet": "a", "row": "in", "col": "2022-13-99", "value": 1},
+        {"sheet": "a", "row": "in", "col": str(START + 1), "value": "x"},
+    ]:
+        ret = server.handle({"updates": [
+            {"sheet": "a", "row": "in", "col": str(START), "value": 1000},
+            bad,
+        ]})
+        assert "error" in ret
+        # どのセルも書き換わっていない
+        assert sheet["in", START].cell.formula.value == 10
+        assert sheet["end", END].value == 50
+
+
+def test_unix_socket(inventory, tmp_path):
+    path = str(tmp_path / "mysheet.sock")
+    server = make_unix_server(SheetServer({"a": inventory(START)}), path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            f = s.makefile("rwb")
+            for value, expected in [(20, 60), (30, 70)]:
+                request = {
+                    "updates": [{"sheet": "a", "row": "in", "col": str(START), "value": value}],
+                    "reads": [{"sheet": "a", "row": "end", "col": str(END)}],
+                }
+                f.write(json.dumps(request).encode() + b"\n")
+                f.flush()
+                assert json.loads(f.readline())["values"] == [expected]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http(inventory):
+    server = make_http_server(SheetServer({"a": inventory(START)}), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection(*server.server_address)
+        body = json.dumps({"reads": [{"sheet": "a", "row": "start", "col": str(START + 1)}]})
+        conn.request("POST", "/", body)
+        response = conn.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read())["values"] == [90]
+
+        conn.request("GET", "/metrics")
+        assert json.loads(conn.getresponse().read())["read"]["count"] == 1
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
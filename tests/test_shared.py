@@ -0,0 +1,101 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from mysheet.shared import VERSION, VERSION_OFFSET, SharedSheetReader
+from mysheet.sheet import Sheet
+from mysheet.ticks import Date
+
+
+def read_row(name, queue):
+    reader = SharedSheetReader(name)
+    version, values = reader.snapshot()
+    queue.put((version, reader.row_names, values[1].tolist()))
+    reader.close()
+
+
+def test_shared(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 2, ["a", "b"])
+    for i in range(3):
+        sheet["a", start + i] = i
+        sheet["b", start + i] = sheet["a", start + i] * 10
+    publisher = sheet.share()
+    try:
+        reader = SharedSheetReader(publisher.name)
+        assert reader.row_names == ["a", "b"]
+        assert reader.col_names == ["2000-01-01", "2000-01-02", "2000-01-03"]
+        assert reader.version == 2
+
+        sheet.calculate()
+        version, values = reader.snapshot()
+        assert version == 4
+        assert values.tolist() == [[0, 1, 2], [0, 10, 20]]
+
+        sheet.update("a", start + 1, 5)
+        # 読み手の配列は共有メモリそのものなので、コピーせずに更新が見える
+        assert reader.row("b").tolist() == [0, 50, 20]
+        reader.close()
+
+        ctx = multiprocessing.get_context("spawn")
+        queue = ctx.Queue()
+        p = ctx.Process(target=read_row, args=(publisher.name, queue))
+        p.start()
+        assert queue.get(timeout=30) == (6, ["a", "b"], [0, 50, 20])
+        p.join()
+    finally:
+        publisher.close()
+
+
+def test_snapshot_waits_for_publisher(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 2, ["a"])
+    for i in range(3):
+        sheet["a", start + i] = i
+    sheet.calculate()
+    publisher = sheet.share()
+    reader = SharedSheetReader(publisher.name)
+    try:
+        # 書き込み中の状態を作り、少し後に書き込みを終える
+        VERSION.pack_into(publisher.shm.buf, VERSION_OFFSET, 3)
+        try:
+            reader.snapshot(timeout=0.01)
+            assert False
+        except TimeoutError:
+            pass
+
+        def finish():
+            time.sleep(0.05)
+            VERSION.pack_into(publisher.shm.buf, VERSION_OFFSET, 4)
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        version, values = reader.snapshot()
+        thread.join()
+        assert version == 4
+        assert values.tolist() == [[0, 1, 2]]
+    finally:
+        reader.close()
+        publisher.close()
+
+
+def test_resize_stops_publishing(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 1, ["a"])
+    sheet["a", start] = 1
+    sheet["a", start + 1] = 2
+    sheet.calculate()
+    publisher = sheet.share()
+    try:
+        version = publisher.version
+        with pytest.warns(RuntimeWarning):
+            sheet.extend(1)
+        sheet["a", start + 2] = 3
+        # 形が変わったあとも、calculateは失敗しない
+        sheet.calculate()
+        assert sheet.get_row_values("a").tolist() == [1, 2, 3]
+        assert publisher.version == version
+    finally:
+        publisher.close()
@@ -1,5 +1,13 @@
+import io
+import math
 from typing import Sequence
-from mysheet.exceptions import AccessEmptyCell, CyclicDependency
+
+import numpy as np
+
+from mysheet import dependency_graph
+from mysheet.exceptions import AccessEmptyCell, CalculationFailed, CyclicDependency
+from mysheet.memo import DiskCache
+from mysheet.row_formula import Ref
 from mysheet.sheet import Sheet
 from mysheet.ticks import Date
 from mysheet.value_task import task
@@ -54,12 +62,62 @@ def test_cycle(clear_graph):
     sheet[a, start] = sheet[a, start + 1]
     sheet[b, start] = sheet[a, start]
     sheet[b, start + 1] = sheet[b, start]
-    sheet[a, start + 1] = sheet[b, start + 1]
     try:
-        sheet.calculate()
+        sheet[a, start + 1] = sheet[b, start + 1]
         assert False
-    except CyclicDependency:
-        pass
+    except CyclicDependency as e:
+        assert e.path == [
+            "(b, 2021-01-02)",
+            "(a, 2021-01-02)",
+            "(a, 2021-01-01)",
+            "(b, 2021-01-01)",
+            "(b, 2021-01-02)",
+        ]
+
+    # 循環を作る式は登録されず、シートは計算できる状態のまま
+    assert sheet[a, start + 1].cell.empty
+
+
+def test_cycle_through_formula(clear_graph):
+    start = Date(2021, 1, 1)
+    sheet = Sheet(start, start, ["a", "b"])
+    sheet["a", start] = 1
+    sheet["b", start] = sheet["a", start] + 1
+    g = dependency_graph.get()
+    nodes = set(g.graph.nodes)
+    try:
+        sheet["a", start] = sheet["b", start] * 2
+        assert False
+    except CyclicDependency as e:
+        # 式のノードを挟んでも、セルで始まりセルで終わる
+        assert e.path == ["(a, 2021-01-01)", "(b, 2021-01-01)", "(a, 2021-01-01)"]
+    # 登録できなかった式のノードは、回収すれば残らない
+    g.collect()
+    assert set(g.graph.nodes) == nodes
+    sheet.calculate()
+    assert sheet["b", start].value == 2
+
+
+def test_reuse_rejected_formula(clear_graph):
+    start = Date(2021, 1, 1)
+    sheet = Sheet(start, start, ["a", "b", "c"])
+    sheet["a", start] = 1
+    sheet["b", start] = sheet["a", start] + 1
+    g = dependency_graph.get()
+    g.auto_collect = True
+    try:
+        doubled = sheet["b", start] * 2
+        try:
+            sheet["a", start] = doubled
+            assert False
+        except CyclicDependency:
+            pass
+        # 循環で断られた式も、持っていれば別のセルで使える
+        sheet["c", start] = doubled
+    finally:
+        g.auto_collect = False
+    sheet.calculate()
+    assert sheet["c", start].value == 4
 
 
 def test_update(clear_graph):
@@ -105,6 +163,33 @@ def test_update2(clear_graph):
     ])
 
 
+def test_update_failure(clear_graph):
+    @task
+    def inv(x):
+        return 1 / x
+
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start, ["a", "b", "c"])
+    sheet["a", start] = 2
+    sheet["b", start] = inv(sheet["a", start])
+    sheet["c", start] = sheet["b", start] * 10
+    sheet.calculate()
+    assert sheet["c", start].value == 5
+
+    try:
+        sheet.update("a", start, 0)
+        assert False
+    except CalculationFailed as e:
+        assert isinstance(e.__cause__, ZeroDivisionError)
+    # 失敗したセルの子孫は、古い値のまま計算済みにならない
+    assert not sheet["b", start].done
+    assert not sheet["c", start].done
+
+    sheet.update("a", start, 4)
+    sheet.calculate()
+    assert sheet["c", start].value == 2.5
+
+
 def test_slice(clear_graph):
     ncol = 10
     start = Date(2021, 1, 1)
@@ -141,8 +226,10 @@ def test_empty(clear_graph):
     try:
         sheet.calculate()
         assert False
-    except AccessEmptyCell:
-        pass
+    except CalculationFailed as e:
+        assert isinstance(e.__cause__, AccessEmptyCell)
+        assert list(e.errors) == [sheet["a", end]]
+        assert e.poisoned == 1
 
 
 def test_parent_cells(clear_graph):
@@ -209,3 +296,405 @@ def test_child_cells(clear_graph):
 
     ps4 = set(sheet.get_child_cells("b", start))
     assert ps4 == set([sheet["c", start].cell])
+
+
+def test_lazy_cell(lazy_graph):
+    start = Date(2000, 1, 1)
+    end = Date(2000, 1, 3)
+    sheet = Sheet(start, end, ["a", "b"])
+    for i in range(3):
+        sheet["a", start + i] = i
+    sheet["b", start] = sheet["a", start] + 1
+    sheet["b", start + 1] = sheet["a", start + 1] + sheet["b", start]
+    sheet["b", start + 2] = sheet["a", start + 2] + sheet["b", start + 1]
+
+    assert sheet["b", start + 1].value == 2
+    assert sheet["b", start].done
+    assert not sheet["b", start + 2].done
+
+    sheet.update("a", start, 10)
+    assert not sheet["b", start + 1].done
+    assert sheet["b", start + 2].value == 14
+
+
+def test_lineage(clear_graph):
+    start = Date(2000, 1, 1)
+    end = Date(2000, 1, 3)
+    sheet = Sheet(start, end, ["in", "stock"])
+    for i in range(3):
+        sheet["in", start + i] = 1
+    sheet["stock", start] = sheet["in", start]
+    for i in range(1, 3):
+        sheet["stock", start + i] = \
+            sheet["stock", start + i - 1] + sheet["in", start + i]
+
+    ancestors = sheet.get_ancestor_cells("stock", end)
+    assert set(ancestors) == set(
+        [sheet["in", start + i].cell for i in range(3)] +
+        [sheet["stock", start + i].cell for i in range(2)])
+
+    near = sheet.get_ancestor_cells("stock", end, depth=1)
+    assert set(near) == set([sheet["stock", start + 1].cell,
+                             sheet["in", end].cell])
+
+    descendants = sheet.get_descendant_cells("in")
+    assert set(descendants) == set(sheet.get_row("stock"))
+
+    # 式を書き換えると索引も更新される
+    sheet["stock", start + 1] = sheet["in", start + 1]
+    assert set(sheet.get_parent_cells("stock", start + 1)) == \
+        set([sheet["in", start + 1].cell])
+    assert sheet["stock", start + 1].cell not in \
+        set(sheet.get_child_cells("stock", start))
+
+
+def test_to_dot(clear_graph, tmp_path):
+    start = Date(2000, 1, 1)
+    end = Date(2000, 1, 3)
+    sheet = Sheet(start, end, ["start", "in", "end"])
+    sheet["start", start] = 10
+    for i in range(3):
+        sheet["in", start + i] = 1
+        if i > 0:
+            sheet["start", start + i] = sheet["end", start + i - 1]
+        sheet["end", start + i] = \
+            sheet["start", start + i] + sheet["in", start + i]
+
+    path = tmp_path / "collapsed.dot"
+    sheet.to_dot(str(path), collapse=True)
+    text = path.read_text()
+    assert '"start" -> "end" [ label = "t" ];' in text
+    assert '"in" -> "end" [ label = "t" ];' in text
+    assert '"end" -> "start" [ label = "t-1" ];' in text
+    assert text.count("->") == 3
+
+    path = tmp_path / "cone.dot"
+    sheet.to_dot(str(path), around=("start", start + 1), depth=1)
+    text = path.read_text()
+    assert '"(end, 2000-01-01)" -> "(start, 2000-01-02)";' in text
+    assert '"(start, 2000-01-02)" -> "(end, 2000-01-02)";' in text
+    assert text.count("->") == 2
+
+
+def test_update_cutoff(clear_graph):
+    calls = []
+
+    @task
+    def clamp(x):
+        calls.append("clamp")
+        return max(x, 0.0)
+
+    @task
+    def double(x):
+        calls.append("double")
+        return x * 2
+
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start, ["a", "b", "c"])
+    sheet["a", start] = -5
+    sheet["b", start] = clamp(sheet["a", start])
+    sheet["c", start] = double(sheet["b", start])
+    sheet.calculate()
+    assert calls == ["clamp", "double"]
+
+    # clampで吸収される変更は、cまで伝わらない
+    ret = sheet.update("a", start, -3)
+    assert calls == ["clamp", "double", "clamp"]
+    assert ret == [sheet["a", start].cell]
+    assert sheet["c", start].value == 0
+
+    sheet.update("a", start, 2)
+    assert calls == ["clamp", "double", "clamp", "clamp", "double"]
+    assert sheet["c", start].value == 4
+
+
+def test_values_as_array(clear_graph):
+    start = Date(2000, 1, 1)
+    end = Date(2000, 1, 3)
+    sheet = Sheet(start, end, ["a", "b"])
+    for i in range(3):
+        sheet["a", start + i] = i
+    sheet["b", start] = sheet["a", start] + 10
+    sheet["b", start + 1] = sheet["a", start + 1] + 10
+
+    values = sheet.get_values(as_array=True)
+    assert values.dtype == np.float64
+    assert values.shape == (2, 3)
+    # 未計算のセルはNaN
+    assert np.isnan(values).all()
+
+    sheet.calculate()
+    assert sheet.get_values(as_array=True)[0].tolist() == [0, 1, 2]
+    # 空のセルもNaN
+    values = sheet.get_values(as_array=True, start=start + 1)
+    assert values[1, 0] == 11
+    assert np.isnan(values[1, 1])
+
+    assert sheet.get_row_values("b", end=start + 1).tolist() == [10, 11]
+    assert sheet.get_col_values(start).tolist() == [0, 10]
+
+
+def test_row_formula(clear_graph):
+    start = Date(2000, 1, 1)
+    end = Date(2000, 1, 5)
+    sheet = Sheet(start, end, ["start", "in", "end"])
+    sheet["start", start] = 100
+    sheet.set_row_formula("start", Ref("end", -1))
+    sheet.set_row_formula("end", Ref("start") + Ref("in") * 2 - 1)
+    for i in range(5):
+        sheet["in", start + i] = i
+
+    # 参照先が範囲外になる最初の列には設定されない
+    assert sheet["start", start].cell.row_formula is None
+    n = len(dependency_graph.get().graph)
+    # 5列分のセル3行と、定数6つ
+    assert n == 5 * 3 + 6
+
+    sheet.calculate()
+    assert sheet.get_row_values("end").tolist() == [99, 100, 103, 108, 115]
+    assert set(sheet.get_parent_cells("end", end)) == set([
+        sheet["start", end].cell, sheet["in", end].cell])
+
+    sheet.update("in", start, 10)
+    assert sheet["end", end].value == 135
+
+    # セルごとの式で上書きできる
+    sheet.update("end", start + 2, 0)
+    assert sheet.get_row_values("end").tolist() == [119, 120, 0, 5, 12]
+
+
+def test_row_formula_infinite_literal(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 1, ["a", "b"])
+    sheet["a", start] = 1
+    sheet["a", start + 1] = -1
+    sheet.set_row_formula("b", Ref("a") * math.inf)
+    sheet.calculate()
+    assert sheet.get_row_values("b").tolist() == [math.inf, -math.inf]
+
+
+def test_row_formula_cycle(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 1, ["a", "b"])
+    sheet.set_row_formula("a", Ref("b"))
+    try:
+        sheet.set_row_formula("b", Ref("a") + 1)
+        assert False
+    except CyclicDependency:
+        pass
+    assert sheet["b", start].cell.empty
+
+
+def test_row_formula_cycle_rollback(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 2, ["a", "b"])
+    for i in range(3):
+        sheet["a", start + i] = (i + 1) * 10
+    sheet["b", start] = 1
+    sheet["b", start + 1] = 2
+    sheet["b", start + 2] = sheet["a", start + 2] * 2
+    # 最後の列だけが循環するので、行全体を元に戻す
+    try:
+        sheet.set_row_formula("a", Ref("b"))
+        assert False
+    except CyclicDependency:
+        pass
+    assert "a" not in sheet.row_formulas
+    for i in range(3):
+        assert sheet["a", start + i].cell.row_formula is None
+    sheet.calculate()
+    assert sheet.get_row_values("a").tolist() == [10, 20, 30]
+    assert sheet.get_row_values("b").tolist() == [1, 2, 60]
+
+    sheet.update("a", start, 5)
+    assert sheet.get_row_values("a").tolist() == [5, 20, 30]
+
+
+def test_checkpoint(clear_graph, tmp_path):
+    calls = []
+
+    @task
+    def stock(prev, x):
+        calls.append(x)
+        return prev + x
+
+    def build(inputs):
+        dependency_graph.clear()
+        start = Date(2000, 1, 1)
+        sheet = Sheet(start, start + 3, ["in", "stock"])
+        for i, v in enumerate(inputs):
+            sheet["in", start + i] = v
+        sheet["stock", start] = sheet["in", start]
+        for i in range(1, 4):
+            sheet["stock", start + i] = stock(
+                sheet["stock", start + i - 1], sheet["in", start + i])
+        return sheet
+
+    sheet = build([1, 2, 3, 4])
+    sheet.calculate()
+    path = str(tmp_path / "sheet.npz")
+    sheet.save_checkpoint(path)
+    assert calls == [2, 3, 4]
+
+    sheet = build([1, 2, 3, 4])
+    assert sheet.restore_checkpoint(path) == []
+    assert sheet.get_row_values("stock").tolist() == [1, 3, 6, 10]
+    assert calls == [2, 3, 4]
+
+    sheet = build([1, 2, 30, 4])
+    dirty = sheet.restore_checkpoint(path)
+    start = Date(2000, 1, 1)
+    assert dirty == [sheet["in", start + 2].cell,
+                     sheet["stock", start + 2].cell,
+                     sheet["stock", start + 3].cell]
+    assert calls == [2, 3, 4, 30, 4]
+    assert sheet.get_row_values("stock").tolist() == [1, 3, 33, 37]
+
+
+def test_checkpoint_warm_start(clear_graph, tmp_path):
+    calls = []
+
+    @task
+    def heavy(x):
+        calls.append(x)
+        return x * 2
+
+    def build():
+        dependency_graph.clear()
+        start = Date(2000, 1, 1)
+        sheet = Sheet(start, start + 2, ["in", "out"])
+        for i in range(3):
+            sheet["in", start + i] = 10 + i
+            sheet["out", start + i] = heavy(sheet["in", start + i]) + 1
+        return sheet
+
+    def csv(sheet):
+        out = io.StringIO()
+        sheet.to_csv(out)
+        return out.getvalue()
+
+    sheet = build()
+    sheet.calculate()
+    expected = csv(sheet)
+    path = str(tmp_path / "sheet.npz")
+    sheet.save_checkpoint(path)
+    assert calls == [10, 11, 12]
+
+    sheet = build()
+    assert sheet.restore_checkpoint(path) == []
+    # 式の根より上の部分式も、計算し直さない
+    sheet.calculate()
+    assert calls == [10, 11, 12]
+    # 整数の値は整数のまま戻る
+    assert csv(sheet) == expected
+    assert "10.0" not in expected
+
+
+def test_sparse(clear_graph):
+    start = Date(2000, 1, 1)
+    end = start + 999
+    sheet = Sheet(start, end, ["order", "arrive"])
+    sheet["order", start + 10] = 5
+    sheet["arrive", start + 13] = sheet["order", start + 10]
+    sheet.calculate()
+
+    # 使ったセルだけが作られる
+    assert [len(row) for row in sheet.cells] == [1, 1]
+    values = sheet.get_values(as_array=True)
+    assert np.count_nonzero(~np.isnan(values)) == 2
+    assert values[1, 13] == 5
+
+    out = io.StringIO()
+    sheet.to_csv(out)
+    assert [len(row) for row in sheet.cells] == [1, 1]
+    lines = out.getvalue().splitlines()
+    assert lines[2].split("\t")[14] == "5"
+
+
+def test_rolling(clear_graph):
+    start = Date(2000, 1, 1)
+    sheet = Sheet(start, start + 2, ["start", "in", "end"])
+    sheet["start", start] = 100
+    sheet.set_row_formula("start", Ref("end", -1), start=start + 1)
+    sheet.set_row_formula("end", Ref("start") + Ref("in"))
+    for i in range(3):
+        sheet["in", start + i] = 1
+    sheet.calculate()
+    g = dependency_graph.get()
+    n = len(g.graph)
+
+    for day in range(10):
+        sheet.retire_before(sheet.start + 1)
+        sheet.extend(1)
+        sheet["in", sheet.end] = 1
+        # 毎日1列ずつ入れ替えても、計算グラフは大きくならない
+        assert len(g.graph) <= n + 1
+        sheet.calculate()
+
+    assert sheet.start == start + 10
+    assert sheet.col_names[0] == "2000-01-11"
+    assert sheet.get_row_values("end").tolist() == [111, 112, 113]
+    assert sheet.get_row_values("start").tolist() == [110, 111, 112]
+    # 捨てた列を参照しているセルの値は、定数として残る
+    assert set(sheet.get_parent_cells("start", sheet.start)) != set()
+
+
+GROW_CALLS = []
+NOISE_CALLS = []
+
+
+@task(pure=True)
+def grow(x):
+    GROW_CALLS.append(x)
+    return x * 2
+
+
+@task
+def noise(x):
+    NOISE_CALLS.append(x)
+    return x
+
+
+def test_disk_cache(clear_graph, tmp_path):
+    start = Date(2000, 1, 1)
+    end = start + 2
+    cache = DiskCache(str(tmp_path / "cache.sqlite"))
+
+    def build(inputs):
+        dependency_graph.clear()
+        sheet = Sheet(start, end, ["in", "out", "noise"])
+        for i, x in enumerate(inputs):
+            sheet["in", start + i] = x
+            sheet["out", start + i] = grow(sheet["in", start + i])
+            sheet["noise", start + i] = noise(sheet["in", start + i])
+        sheet.calculate()
+        return sheet
+
+    g = dependency_graph.get()
+    g.cache = cache
+    try:
+        build([1, 2, 3])
+        assert GROW_CALLS == [1, 2, 3]
+        assert NOISE_CALLS == [1, 2, 3]
+
+        # 別の実行で同じシートを作ると、純粋なタスクは実行しない
+        sheet = build([1, 2, 3])
+        assert GROW_CALLS == [1, 2, 3]
+        assert NOISE_CALLS == [1, 2, 3] * 2
+        assert list(sheet.get_row_values("out")) == [2, 4, 6]
+
+        # 入力が変わったセルだけを計算する
+        sheet = build([1, 5, 3])
+        assert GROW_CALLS == [1, 2, 3, 5]
+        assert list(sheet.get_row_values("out")) == [2, 10, 6]
+    finally:
+        g.cache = None
+
+    cache.clear()
+    assert cache.size() == 0
+    small = DiskCache(str(tmp_path / "small.sqlite"), max_bytes=100)
+    small.put("a", b"x" * 40)
+    small.put("b", b"x" * 40)
+    small.put("c", b"x" * 40)
+    assert not small.lookup("a")[0]
+    assert small.lookup("c") == (True, b"x" * 40)
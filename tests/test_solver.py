@@ -0,0 +1,85 @@
+import numpy as np
+
+from mysheet import solver
+from mysheet.dual import Dual
+from mysheet.exceptions import NoSolution
+from mysheet.ticks import Date
+from mysheet.value_task import task
+
+
+START = Date(2022, 5, 30)
+END = START + 4
+
+
+@task
+def at_least_zero(x):
+    return max(x, 0)
+
+
+def test_goal_seek(inventory):
+    sheet = inventory(START, out_step=5)
+    days = [START + i for i in range(5)]
+    x = sheet.goal_seek(
+        [("end", d) for d in days], 50, [("in", d) for d in days], 0, 100, tol=1e-6)
+    # 出荷量の合計は150なので、毎日20入荷すれば期末在庫は最後に50になる
+    assert abs(x - 20) < 1e-5
+    assert x >= 20
+    # 元のシートは変わらない
+    assert sheet["in", START].value == 10
+
+    try:
+        sheet.goal_seek(("end", END), 1000, [("in", START)], 0, 100)
+        assert False
+    except NoSolution:
+        pass
+
+
+def test_goal_seek_fallback(inventory):
+    # 配列を扱えないタスクがあっても、候補ごとの計算で解ける
+    sheet = inventory(START, out_step=5, clip=at_least_zero)
+    x = sheet.goal_seek(("end", END), 50, [("in", START + i) for i in range(5)],
+                        0, 100, tol=1e-6)
+    assert abs(x - 20) < 1e-5
+
+
+def test_optimize(inventory):
+    sheet = inventory(START, out_step=5)
+    # 最終日の期末在庫を100にする、初日と最終日の入荷量
+    best, value = sheet.optimize(
+        ("end", END), [("in", START), ("in", END)], [(0, 100), (0, 100)],
+        reduce=lambda v, axis: np.abs(v - 100).sum(axis=axis))
+    assert abs(best.sum() - 120) < 1e-6
+    assert value < 1e-6
+
+
+@task(differentiable=True)
+def square(x):
+    return x * x
+
+
+def test_sensitivities(inventory):
+    sheet = inventory(START, out_step=5)
+    days = [START + i for i in range(5)]
+    jac = sheet.sensitivities(
+        [("end", START), ("end", END)],
+        [("in", d) for d in days] + [("out", d) for d in days])
+    assert jac.shape == (2, 10)
+    assert jac[0].tolist() == [1, 0, 0, 0, 0, -1, 0, 0, 0, 0]
+    assert jac[1].tolist() == [1] * 5 + [-1] * 5
+
+    # 微分に対応した関数は微分を伝え、対応していない関数の先はNaNになる
+    a = square(sheet["end", END] - 10)
+    b = at_least_zero(sheet["end", START])
+    sheet.calculate()
+    jac = solver.jacobian(sheet, [a, b], [sheet["in", START]])
+    assert jac[0, 0] == 2 * (0 - 10)
+    assert np.isnan(jac[1, 0])
+
+
+def test_dual_compare():
+    g = np.array([1.0])
+    assert Dual(0.0, g) == 0
+    assert 0 == Dual(0.0, g)
+    assert Dual(1.0, g) != Dual(2.0, g)
+    assert not (Dual(1.0, g) != 1.0)
+    assert max(Dual(1.0, g), 0.5).value == 1.0
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+SCRIPT = """
+import json, runpy, sys, time
+begin = time.perf_counter()
+sys.argv = ["mysheet", "--no-progress", "forward"]
+try:
+    runpy.run_module("mysheet", run_name="__main__")
+except SystemExit:
+    pass
+print(json.dumps({
+    "total": time.perf_counter() - begin,
+    "modules": sorted(m for m in sys.modules if "." not in m),
+}), file=sys.stderr)
+"""
+
+# CLIに必ず要るclickを読み込むだけの時間。これとの差で比べる
+BASELINE = """
+import sys, time
+begin = time.perf_counter()
+import click
+print(time.perf_counter() - begin, file=sys.stderr)
+"""
+
+# 機能を使うときだけ読み込むモジュール
+LAZY = ["jinja2", "networkx", "mdweek", "asyncio", "sqlite3", "tqdm", "numpy"]
+
+# clickの読み込みを除いた、パッケージの読み込みと計算にかける時間の上限(秒)
+# 手元では0.02〜0.03秒ほど。重いモジュールを1つ読み込むと超える
+BUDGET = 0.06
+
+
+def run(script: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True)
+
+
+def last_json(proc: subprocess.CompletedProcess) -> dict:
+    return json.loads(proc.stderr.strip().splitlines()[-1])
+
+
+def test_startup():
+    """
+    起動して小さなシートを計算するときに、重いモジュールを読み込まないことを確かめる
+    """
+    proc = run(SCRIPT)
+    result = last_json(proc)
+    assert proc.stdout.startswith("\t2022-05-30")
+    for m in LAZY:
+        assert m not in result["modules"], m
+
+
+@pytest.mark.skipif(
+    os.environ.get("MYSHEET_BENCH") is None,
+    reason="時間を測るのは、MYSHEET_BENCH=1を指定したときだけ")
+def test_startup_time():
+    """
+    起動して小さなシートを計算するまでの時間が、大きく伸びていないことを確かめる
+    負荷の高い環境では不安定なので、既定では実行しない
+    """
+    # ばらつきを抑えるため、それぞれ何回か測って最短の時間で比べる
+    total = min(last_json(run(SCRIPT))["total"] for _ in range(3))
+    baseline = min(
+        float(run(BASELINE).stderr.strip().splitlines()[-1]) for _ in range(3))
+    assert total - baseline < BUDGET
@@ -1,6 +1,7 @@
 from mysheet.exceptions import NotEvaluated
 from mysheet.value_task import Constant, ValueArray, ValueTask, task
 from mysheet import dependency_graph
+from mysheet.memo import digest_function
 
 
 def test_constant():
@@ -108,3 +109,59 @@ def test_reset(clear_graph):
         assert False
     except NotEvaluated:
         pass
+
+
+def test_memoize(clear_graph):
+    calls = []
+
+    @task(pure=True, cache=2)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    a = square(Constant(3))
+    b = square(Constant(3))
+    c = square(Constant(4))
+    dependency_graph.get().calculate()
+
+    assert (a.value, b.value, c.value) == (9, 9, 16)
+    assert calls == [3, 4]
+    info = square.cache.info()
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+
+    # 最大件数を超えると、最も古い結果から捨てられる
+    d = square(Constant(5))
+    e = square(Constant(3))
+    dependency_graph.get().calculate()
+    assert (d.value, e.value) == (25, 9)
+    assert calls == [3, 4, 5, 3]
+
+
+def test_cache_requires_pure():
+    try:
+        @task(cache=10)
+        def f(x):
+            return x
+        assert False
+    except ValueError:
+        pass
+
+
+def test_digest_function():
+    def f(x, k=2):
+        return x * k
+
+    def g(x, k=3):
+        return x * k
+
+    def h(x, *, k=2):
+        return x * k
+
+    def i(x, *, k=3):
+        return x * k
+
+    # 名前とバイトコードが同じでも、既定値が違えば別の指紋になる
+    g.__qualname__ = f.__qualname__
+    i.__qualname__ = h.__qualname__
+    assert digest_function(f) != digest_function(g)
+    assert digest_function(h) != digest_function(i)